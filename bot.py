@@ -1,19 +1,24 @@
 import asyncio
 import logging
+import math
+import multiprocessing
+import os
+import sys
 import aiosqlite
 import pandas as pd
-from datetime import datetime, date
-from aiogram import Bot, Dispatcher, types
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    ReplyKeyboardMarkup,
-    KeyboardButton
+    FSInputFile
 )
+from update_dispatch import AsyncUpdateDispatcher as UpdateDispatcher
 
-
+API_TOKEN = os.environ.get("API_TOKEN", "")
 
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=API_TOKEN)
@@ -38,46 +43,296 @@ async def init_db():
                 upload_date TEXT
             )
         """)
+        # 按日 / 按月的收支汇总，随 save_transaction 增量更新
+        for table, key in (("daily_totals", "day"), ("monthly_totals", "month")):
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {key} TEXT PRIMARY KEY,
+                    income REAL NOT NULL DEFAULT 0,
+                    expense REAL NOT NULL DEFAULT 0
+                )
+            """)
+        # 归一化日期：date 存 ISO 字符串，day 存日期序数，区间查询走 (day, type, amount) 索引
+        cursor = await db.execute("PRAGMA table_info(transactions)")
+        if "day" not in [c[1] for c in await cursor.fetchall()]:
+            await db.execute("ALTER TABLE transactions ADD COLUMN day INTEGER")
+            cursor = await db.execute("SELECT id, date FROM transactions")
+            updates = []
+            for tx_id, raw in await cursor.fetchall():
+                d = parse_date(raw)
+                if d:
+                    updates.append((d.isoformat(), d.toordinal(), tx_id))
+            await db.executemany("UPDATE transactions SET date = ?, day = ? WHERE id = ?", updates)
+            await rebuild_rollups(db)
+        # Telegram 上已有的 file_id：/getexcel 直接复用，不再从磁盘重新上传
+        cursor = await db.execute("PRAGMA table_info(excel_files)")
+        if "tg_file_id" not in [c[1] for c in await cursor.fetchall()]:
+            await db.execute("ALTER TABLE excel_files ADD COLUMN tg_file_id TEXT")
+        await db.execute("CREATE INDEX IF NOT EXISTS ix_transactions_day ON transactions(day, type, amount)")
+        cursor = await db.execute("SELECT COUNT(*) FROM daily_totals")
+        if (await cursor.fetchone())[0] == 0:
+            # 旧库首次升级：从已有交易回填汇总
+            await rebuild_rollups(db)
         await db.commit()
 
+async def rebuild_rollups(db):
+    await db.execute("DELETE FROM daily_totals")
+    await db.execute("DELETE FROM monthly_totals")
+    await db.execute("""
+        INSERT INTO daily_totals (day, income, expense)
+        SELECT date,
+               SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END),
+               SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END)
+        FROM transactions GROUP BY date
+    """)
+    await db.execute("""
+        INSERT INTO monthly_totals (month, income, expense)
+        SELECT substr(date, 1, 7),
+               SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END),
+               SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END)
+        FROM transactions GROUP BY substr(date, 1, 7)
+    """)
+
+# ✅ 日期归一化
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y/%m/%d", "%d.%m.%y")
+
+def parse_date(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text[:10] if fmt == "%Y-%m-%d" else text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def day_ordinal(iso):
+    return datetime.strptime(iso, "%Y-%m-%d").toordinal()
+
+ROLLUP_UPSERT = """
+    INSERT INTO {table} ({key}, income, expense) VALUES (?, ?, ?)
+    ON CONFLICT({key}) DO UPDATE SET
+        income = income + excluded.income,
+        expense = expense + excluded.expense
+"""
+
+async def bump_rollups_many(db, rows):
+    # 先在内存里按日/月合并，每个键只 upsert 一次
+    days, months = {}, {}
+    for day, t_type, amount in rows:
+        if t_type not in ("income", "expense"):
+            continue
+        slot = 0 if t_type == "income" else 1
+        for bucket, key in ((days, day), (months, day[:7])):
+            bucket.setdefault(key, [0.0, 0.0])[slot] += amount
+    if days:
+        await db.executemany(ROLLUP_UPSERT.format(table="daily_totals", key="day"),
+                             [(k, v[0], v[1]) for k, v in days.items()])
+        await db.executemany(ROLLUP_UPSERT.format(table="monthly_totals", key="month"),
+                             [(k, v[0], v[1]) for k, v in months.items()])
+
+# ✅ 数据库层：每个进程一个，main() 里 init_db() 之后创建
+# 一个常驻写连接 + 几个只读连接（WAL 下读不阻塞写）。写操作进入队列，写协程在很短的
+# 窗口内把多个写合并成一次提交；SQL 文本固定，命中 sqlite3 的语句缓存。
+INSERT_TX = "INSERT INTO transactions (date, day, type, amount, source) VALUES (?, ?, ?, ?, ?)"
+INSERT_EXCEL = "INSERT INTO excel_files (file_name, upload_date, tg_file_id) VALUES (?, ?, ?)"
+
+class _WriteItem:
+    __slots__ = ("fn", "exclusive", "future")
+
+    def __init__(self, fn, exclusive, future):
+        self.fn = fn
+        self.exclusive = exclusive
+        self.future = future
+
+class Database:
+    def __init__(self, path="finance.db", readers=3, commit_window=0.01, max_batch=200):
+        self.path = path
+        self.n_readers = readers
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self._writer = None
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._carry = None
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.n_readers):
+            conn = await self._connect()
+            await conn.execute("PRAGMA query_only=ON")
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        self._task = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        for conn in self._all_readers:
+            await conn.close()
+        await self._writer.close()
+
+    # ---- 写 ----
+    async def write(self, fn, exclusive=False):
+        """fn(conn) 在写连接上执行；提交后返回 fn 的结果。exclusive=True 时单独占一个事务。"""
+        if self._task is None:
+            raise RuntimeError("database is closed")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_WriteItem(fn, exclusive, future))
+        return await future
+
+    async def execute_write(self, sql, params=()):
+        async def fn(conn):
+            await conn.execute(sql, params)
+        return await self.write(fn)
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, self._carry = self._carry, None
+            if item is None:
+                item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if not item.exclusive:
+                deadline = loop.time() + self.commit_window
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        nxt = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if nxt is None or nxt.exclusive:
+                        await self._run_batch(batch)
+                        batch = []
+                        if nxt is None:
+                            return
+                        self._carry = nxt
+                        break
+                    batch.append(nxt)
+            if batch:
+                await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        try:
+            results = [await it.fn(self._writer) for it in batch]
+            await self._writer.commit()
+        except Exception as e:
+            await self._writer.rollback()
+            if len(batch) == 1:
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(e)
+                return
+            # 整批回滚后逐个重试，只让真正出错的那个失败
+            for it in batch:
+                await self._run_batch([it])
+            return
+        for it, res in zip(batch, results):
+            if not it.future.done():
+                it.future.set_result(res)
+
+    # ---- 读 ----
+    async def fetchall(self, sql, params=()):
+        conn = await self._readers.get()
+        try:
+            cursor = await conn.execute(sql, params)
+            return await cursor.fetchall()
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+DB = None
+
 # ✅ 保存交易记录
 async def save_transaction(date, t_type, amount, source):
-    async with aiosqlite.connect("finance.db") as db:
-        await db.execute(
-            "INSERT INTO transactions (date, type, amount, source) VALUES (?, ?, ?, ?)",
-            (date, t_type, amount, source)
-        )
-        await db.commit()
+    async def fn(conn):
+        await conn.execute(INSERT_TX, (date, day_ordinal(date), t_type, amount, source))
+        await bump_rollups_many(conn, [(date, t_type, amount)])
+    await DB.write(fn)
+
+# ✅ 批量保存（一个事务；任何一行无效则整体回滚）
+BULK_CHUNK = 1000
+
+async def save_transactions_bulk(rows, source, progress=None):
+    """
+    先整体校验（日期统一成 ISO），再在独占写事务里分块插入。progress(done, total) 是普通函数，在事务里同步调用：
+    只能记数，不能等网络；此时这些行只是“已准备”，DB.write 返回后才算提交。
+    """
+    normalized = []
+    for i, (day, t_type, amount) in enumerate(rows, 1):
+        if t_type not in ("income", "expense"):
+            raise ValueError(f"{i}-жол: түрі қате ({t_type})")
+        d = parse_date(day) if day else None
+        if d is None or not math.isfinite(amount):
+            raise ValueError(f"{i}-жол: күні немесе сомасы қате")
+        normalized.append((d.isoformat(), t_type, amount))
+    rows = normalized
+
+    async def fn(conn):
+        for start in range(0, len(rows), BULK_CHUNK):
+            part = rows[start:start + BULK_CHUNK]
+            await conn.executemany(INSERT_TX, [(d, day_ordinal(d), t, a, source) for d, t, a in part])
+            if progress:
+                progress(start + len(part), len(rows))
+        await bump_rollups_many(conn, rows)
+        return len(rows)
+    return await DB.write(fn, exclusive=True)
 
 # ✅ 保存 Excel 文件信息
-async def save_excel_info(file_name):
+async def save_excel_info(file_name, tg_file_id=None):
     upload_date = datetime.now().strftime("%Y-%m-%d")
-    async with aiosqlite.connect("finance.db") as db:
-        await db.execute(
-            "INSERT INTO excel_files (file_name, upload_date) VALUES (?, ?)",
-            (file_name, upload_date)
-        )
-        await db.commit()
+    await DB.execute_write(INSERT_EXCEL, (file_name, upload_date, tg_file_id))
 
-# ✅ 获取统计
+# ✅ 获取统计（读汇总表，不再逐行累加）
 async def get_summary(target_date=None):
-    async with aiosqlite.connect("finance.db") as db:
-        if target_date:
-            cursor = await db.execute("SELECT type, amount FROM transactions WHERE date = ?", (target_date,))
-        else:
-            cursor = await db.execute("SELECT type, amount FROM transactions")
-        rows = await cursor.fetchall()
+    if target_date:
+        row = await DB.fetchone("SELECT income, expense FROM daily_totals WHERE day = ?", (target_date,))
+    else:
+        row = await DB.fetchone("SELECT SUM(income), SUM(expense) FROM monthly_totals")
+
+    income = (row[0] or 0.0) if row else 0.0
+    expense = (row[1] or 0.0) if row else 0.0
+    return income, expense, income - expense
 
-    income = sum(r[1] for r in rows if r[0] == "income")
-    expense = sum(r[1] for r in rows if r[0] == "expense")
+# ✅ 区间统计：SQL 里 SUM ... GROUP BY，走 day 索引的区间扫描
+async def get_range_summary(start, end):
+    rows = await DB.fetchall(
+        "SELECT type, SUM(amount) FROM transactions WHERE day BETWEEN ? AND ? GROUP BY type",
+        (start.toordinal(), end.toordinal())
+    )
+    totals = dict(rows)
+    income = totals.get("income") or 0.0
+    expense = totals.get("expense") or 0.0
     return income, expense, income - expense
 
+def format_summary(title, income, expense, balance):
+    return f"{title}\n💰 Кіріс: {income:.2f} тг\n💸 Шығын: {expense:.2f} тг\n⚖️ Баланс: {balance:.2f} тг"
+
 # ✅ 获取 Excel 文件（按上传日期）
 async def get_excel_files_by_date(target_date):
-    async with aiosqlite.connect("finance.db") as db:
-        cursor = await db.execute("SELECT file_name FROM excel_files WHERE upload_date = ?", (target_date,))
-        files = await cursor.fetchall()
-    return [f[0] for f in files]
+    return await DB.fetchall("SELECT id, file_name, tg_file_id FROM excel_files WHERE upload_date = ?", (target_date,))
 
 # ✅ /start
 @dp.message(Command("start"))
@@ -104,7 +359,9 @@ async def cmd_start(message: Message):
         "📊 Сондай-ақ:\n"
         "`/summary` — барлық кіріс/шығысты көру\n"
         "`/today` — бүгінгі статистиканы көру\n"
-        "`/summary 2025-10-04` — белгілі күнді көру",
+        "`/summary 2025-10-04` — белгілі күнді көру\n"
+        "`/summary 2025-10-01 2025-10-31` — кезең бойынша есеп\n"
+        "`/week`, `/month` — осы аптаның / айдың есебі",
         parse_mode="Markdown",
         reply_markup=keyboard
     )
@@ -129,14 +386,42 @@ async def add_manual(message: Message):
     except Exception:
         await message.answer("❌ Формат қате. Мысалы: `/add income 2000`", parse_mode="Markdown")
 
-# ✅ /summary
+# ✅ /summary [FROM [TO]]
 @dp.message(Command("summary"))
 async def cmd_summary(message: Message):
     args = message.text.split()
-    target_date = args[1] if len(args) == 2 else None
+    if len(args) == 3:
+        start, end = parse_date(args[1]), parse_date(args[2])
+        if not start or not end:
+            await message.answer("❌ Қате формат. Мысалы: `/summary 2025-10-01 2025-10-31`", parse_mode="Markdown")
+            return
+        start, end = min(start, end), max(start, end)
+        income, expense, balance = await get_range_summary(start, end)
+        await message.answer(format_summary(f"📅 {start} — {end} есебі:", income, expense, balance))
+        return
+    target_date = None
+    if len(args) == 2:
+        d = parse_date(args[1])
+        target_date = d.isoformat() if d else args[1]
     income, expense, balance = await get_summary(target_date)
     title = f"📅 {target_date} күнгі есеп:" if target_date else "📊 Жалпы есеп:"
-    await message.answer(f"{title}\n💰 Кіріс: {income:.2f} тг\n💸 Шығын: {expense:.2f} тг\n⚖️ Баланс: {balance:.2f} тг")
+    await message.answer(format_summary(title, income, expense, balance))
+
+# ✅ /week — осы апта (дүйсенбіден бүгінге дейін)
+@dp.message(Command("week"))
+async def cmd_week(message: Message):
+    today = date.today()
+    start = today - timedelta(days=today.weekday())
+    income, expense, balance = await get_range_summary(start, today)
+    await message.answer(format_summary(f"🗓 Апталық есеп ({start} — {today}):", income, expense, balance))
+
+# ✅ /month — осы ай
+@dp.message(Command("month"))
+async def cmd_month(message: Message):
+    today = date.today()
+    start = today.replace(day=1)
+    income, expense, balance = await get_range_summary(start, today)
+    await message.answer(format_summary(f"🗓 Айлық есеп ({start} — {today}):", income, expense, balance))
 
 # ✅ /today
 @dp.message(Command("today"))
@@ -162,15 +447,84 @@ async def cmd_getexcel(message: Message):
         await message.answer(f"📂 {target_date} үшін ешқандай Excel табылмады.")
         return
 
-    for file_name in files:
-        with open(file_name, "rb") as f:
-            await bot.send_document(message.chat.id, f, caption=f"📎 {file_name}")
+    for row_id, file_name, tg_file_id in files:
+        if tg_file_id:
+            await bot.send_document(message.chat.id, tg_file_id, caption=f"📎 {file_name}")
+            continue
+        # 旧记录没有 file_id：上传一次，记下 Telegram 返回的 file_id
+        sent = await bot.send_document(message.chat.id, FSInputFile(file_name), caption=f"📎 {file_name}")
+        await DB.execute_write("UPDATE excel_files SET tg_file_id = ? WHERE id = ?", (sent.document.file_id, row_id))
 
 # ✅ /upload
 @dp.message(Command("upload"))
 async def cmd_upload(message: Message):
     await message.answer("📤 Excel файлын жіберіңіз (.xlsx немесе .xls), мен оны талдап сақтаймын.")
 
+# ✅ Excel 行解析（整列转换，不逐行 iterrows）
+def excel_rows(df):
+    today = datetime.now().strftime("%Y-%m-%d")
+    if "Date" in df.columns:
+        # 先按 ISO 解析，失败的再按 日.月.年 解析；无法识别的留空，由批量保存拒绝
+        parsed = pd.to_datetime(df["Date"], errors="coerce", format="ISO8601")
+        retry = parsed.isna() & df["Date"].notna()
+        if retry.any():
+            parsed = parsed.where(~retry, pd.to_datetime(df["Date"].where(retry), errors="coerce", dayfirst=True))
+        dates = parsed.dt.strftime("%Y-%m-%d").where(parsed.notna(), None)
+        dates = dates.where(df["Date"].notna(), today)
+    else:
+        dates = pd.Series(today, index=df.index)
+    kinds = df["Type"].astype(str).str.lower().where(df["Type"].notna(), "income") if "Type" in df.columns else pd.Series("income", index=df.index)
+    amounts = df["Amount"].astype(float) if "Amount" in df.columns else pd.Series(0.0, index=df.index)
+    return list(zip(dates.tolist(), kinds.tolist(), amounts.tolist()))
+
+def parse_excel_rows(path):
+    # 在进程池里执行：pd.read_excel 和列转换都是 CPU 密集的
+    return excel_rows(pd.read_excel(path))
+
+# ✅ 重活放进进程池，事件循环只负责等待结果
+class OffloadPool:
+    """有界进程池 + 每个用户的并发上限；waiting / in_pool 两个计数作为队列深度指标。"""
+
+    def __init__(self, workers=2, per_user=1):
+        self.workers = workers
+        self.per_user = per_user
+        self._executor = None
+        self._user_slots = {}
+        self.waiting = 0   # 等用户名额
+        self.in_pool = 0   # 已提交到进程池、尚未完成
+
+    @property
+    def depth(self):
+        return self.waiting + self.in_pool
+
+    def start(self):
+        # spawn 而不是 fork：启动时 aiosqlite 的线程已在跑，fork 出的子进程会带着它们持有的锁
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, user_id, fn, *args):
+        slot = self._user_slots.setdefault(user_id, asyncio.Semaphore(self.per_user))
+        self.waiting += 1
+        logging.info("offload queue depth: %d", self.depth)
+        try:
+            await slot.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_pool += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_pool -= 1
+            slot.release()
+
+OFFLOAD = OffloadPool()
+PROGRESS_INTERVAL = 1.0   # 秒；Excel 导入进度消息的最短编辑间隔
+
 # ✅ 接收 Excel 文件
 @dp.message(lambda msg: msg.document)
 async def handle_excel_file(message: Message):
@@ -182,25 +536,91 @@ async def handle_excel_file(message: Message):
     file_id = message.document.file_id
     file = await bot.get_file(file_id)
     await bot.download_file(file.file_path, file_name)
-    await save_excel_info(file_name)
+    await save_excel_info(file_name, file_id)
 
     try:
-        df = pd.read_excel(file_name)
-        count = 0
-        for _, row in df.iterrows():
-            date_val = str(row.get("Date", datetime.now().strftime("%Y-%m-%d")))
-            t_type = str(row.get("Type", "income")).lower()
-            amount = float(row.get("Amount", 0))
-            await save_transaction(date_val, t_type, amount, "excel")
-            count += 1
+        rows = await OFFLOAD.run(message.from_user.id, parse_excel_rows, file_name)
+        status = await message.answer(f"⏳ {len(rows)} жазба сақталуда...")
+        prepared = [0]
+
+        def progress(done, total):
+            # 写事务里只记数；编辑消息放到事务外的任务里，不占着写连接等 Telegram
+            prepared[0] = done
+
+        async def report():
+            shown = 0
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                if prepared[0] != shown:
+                    shown = prepared[0]
+                    try:
+                        await status.edit_text(f"⏳ Дайындалды: {shown}/{len(rows)}")
+                    except Exception:
+                        logging.exception("progress update failed")
+
+        reporter = asyncio.create_task(report())
+        try:
+            count = await save_transactions_bulk(rows, "excel", progress)
+        finally:
+            reporter.cancel()
         await message.answer(f"📊 Файл '{file_name}' жүктелді және {count} жазба сақталды!")
     except Exception as e:
         await message.answer(f"❌ Excel оқу кезінде қате: {e}")
 
-# ✅ 启动主程序
+# ✅ Webhook 模式：本地 HTTP 服务接收更新，每个 chat 串行、整体限并发，按 update_id 去重
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8444
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""        # 对外的 https 地址；为空时不调用 setWebhook（本地回放测试用）
+WEBHOOK_SECRET = ""     # 非空时校验 X-Telegram-Bot-Api-Secret-Token
+
+async def feed_update(update):
+    await dp.feed_raw_update(bot, update)
+
+async def start_webhook(host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    from aiohttp import web
+    dispatcher = UpdateDispatcher(feed_update)
+
+    async def receive(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if dispatcher.submit(update) == "busy":
+            return web.Response(status=503)   # Telegram 会稍后重发
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    logging.info("webhook listening on http://%s:%d%s", host, port, WEBHOOK_PATH)
+    return runner
+
+# ✅ 启动主程序（python bot.py webhook [port] 进入 webhook 模式）
 async def main():
+    global DB
     await init_db()
-    await dp.start_polling(bot)
+    DB = Database("finance.db")
+    await DB.open()
+    OFFLOAD.start()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "webhook":
+            runner = await start_webhook(port=int(sys.argv[2]) if len(sys.argv) > 2 else WEBHOOK_PORT)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await runner.cleanup()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        OFFLOAD.shutdown()
+        await DB.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -4,19 +4,37 @@
 
 import os
 import re
+import sys
+import io
+import csv
+import copy
+import gzip
 import json
+import bisect
+import hashlib
 import time
 import uuid
+import queue
+import threading
+import sqlite3
+import tempfile
 import traceback
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from datetime import datetime, date, timezone, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple, Callable
 
 import requests
+import requests.adapters
 import telebot
+import numpy as np
 import pandas as pd
 
+from update_dispatch import UpdateDispatcher
 
-BOT_TOKEN = ""  
+
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 OLLAMA_URL = ""         
 MODEL_NAME = "mistral"
 DATA_DIR = "data"
@@ -24,8 +42,26 @@ FILES_DIR = os.path.join(DATA_DIR, "files")
 os.makedirs(FILES_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 
-SAVE_MODE = "single"   # "single" 或 "daily"
+SAVE_MODE = "single"   # "single"、"daily"、"journal"、"sqlite" 或 "sharded"
 DEFAULT_DATA_FILE = os.path.join(DATA_DIR, "finance_data.json")
+SQLITE_FILE = os.path.join(DATA_DIR, "finance.db")
+JOURNAL_FILE = os.path.join(DATA_DIR, "finance_journal.jsonl")
+JOURNAL_COMPACT_EVERY = 5000   # journal 超过该行数后压缩成快照
+SHARD_DIR = os.path.join(DATA_DIR, "shards")
+SHARD_BUCKETS = 256            # sharded 模式：用户按哈希分到这么多个目录
+SHARD_CACHE_PARTITIONS = 256   # sharded 模式：内存里保留的最近分区文件数
+RETENTION_DAYS = 90            # 超过该天数的对话记录和 source_text 移入冷归档
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+ARCHIVE_EVERY = 24 * 3600      # 归档任务的运行间隔（秒）
+ARCHIVE_CHUNK = 2000           # 归档删除 / 清字段时每次提交给写线程的 op 数
+WRITE_BATCH_MAX = 200          # 写线程一批最多合并的提交数
+WRITE_FLUSH_SECONDS = 0.02     # 第一条提交到达后最多再等这么久凑一批
+UNDO_DEPTH = 20                # 每个用户可撤销 / 重做的步数
+WEBHOOK_HOST = "127.0.0.1"     # webhook 模式：本地监听地址（前面放反向代理 / TLS）
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""               # 对外的 https 地址；为空时不调用 setWebhook（本地回放测试用）
+WEBHOOK_SECRET = ""            # 非空时校验 X-Telegram-Bot-Api-Secret-Token
 OLLAMA_API_ENDPOINT = OLLAMA_URL.rstrip("/") + "/api/generate"
 
 # -------------------- Қазақша мәтіндер --------------------
@@ -35,14 +71,28 @@ KZ = {
     "saved_single": "Жазба сақталды: {type} — {amount:.2f} KZT ({date})\n{desc}",
     "ask_confirm_unknown": "Кейбір сандардың түрін анықтай алмадым: {items}\nТүзету үшін қысқа сөйлем жазыңыз (мысалы: 'сол 2-ні шығыс деп өзгерту').",
     "no_amount": "Сандар табылмады — нақты соманы жіберіңіз немесе Excel жіберіңіз.",
+    "llm_pending": "Хабарламаны талдап жатырмын — нәтижені сәл кейін жіберемін.",
     "error": "Қате: {err}",
     "today_summary": "Бүгінгі есеп — Кіріс: {inc:.2f} KZT; Шығыс: {exp:.2f} KZT; Таза: {net:+.2f} KZT.",
+    "range_summary": "{start} — {end} есебі — Кіріс: {inc:.2f} KZT; Шығыс: {exp:.2f} KZT; Таза: {net:+.2f} KZT.",
     "file_saved": "Файл сақталды және өңделді: {count} жазба табылды.",
+    "file_saved_dupes": "Файл сақталды және өңделді: {count} жаңа жазба; {skipped} жазба бұрын енгізілген, өткізіп жіберілді.",
+    "file_dropped": "{dropped} жолдағы соманы оқу мүмкін болмады — олар өткізіп жіберілді.",
+    "file_partial": "Файл толық оқылмады ({err}): оған дейінгі {count} жазба сақталды. Файлды қайта жіберсеңіз, сақталған жолдар өткізіліп, қалғаны қосылады.",
     "deleted_ok": "Жазба(лар) жойылды: {n}.",
     "edited_ok": "Жазба өзгертілді.",
+    "undo_ok": "Соңғы әрекет болдырылмады.",
+    "redo_ok": "Әрекет қайта орындалды.",
+    "nothing_to_undo": "Болдырмайтын әрекет жоқ.",
+    "nothing_to_redo": "Қайталайтын әрекет жоқ.",
     "export_ready": "Сұралған экспорт дайын — файл жіберілді.",
     "file_not_found": "Көрсетілген файл табылмады.",
-    "no_transactions": "Осы күнге жазба табылмады."
+    "no_transactions": "Осы күнге жазба табылмады.",
+    "report_line": "{label}: Кіріс {inc:.2f}; Шығыс {exp:.2f}; Таза {net:+.2f}",
+    "weekly_report": "Апталық есеп (соңғы {n} апта):\n{lines}\n7 күндік орташа шығыс: {ma:.2f} KZT/күн.",
+    "monthly_report": "Айлық есеп (соңғы {n} ай):\n{lines}\nОсы айдағы ең үлкен шығыстар:\n{top}",
+    "category_report": "{start} — {end} санаттар бойынша шығыс:\n{lines}",
+    "source_report": "{date} жазбаларының бастапқы хабарламалары:\n{lines}"
 }
 
 # -------------------- JSON 存取 --------------------
@@ -52,10 +102,21 @@ def data_filepath(for_date: Optional[date] = None) -> str:
         return os.path.join(DATA_DIR, f"{d.isoformat()}.json")
     return DEFAULT_DATA_FILE
 
-def load_data() -> Dict[str, Any]:
-    fp = data_filepath()
+DAILY_FILE_RE = re.compile(r'(\d{4}-\d{2}-\d{2})\.json')
+
+def daily_dates() -> List[date]:
+    """daily 模式下已有的日文件日期（升序）。"""
+    return sorted(date.fromisoformat(m.group(1)) for m in map(DAILY_FILE_RE.fullmatch, os.listdir(DATA_DIR)) if m)
+
+DATA_KINDS = ("conversations", "transactions", "files")
+
+def empty_data() -> Dict[str, Any]:
+    return {k: [] for k in DATA_KINDS}
+
+def load_data(for_date: Optional[date] = None) -> Dict[str, Any]:
+    fp = data_filepath(for_date)
     if not os.path.exists(fp):
-        base = {"conversations": [], "transactions": [], "files": []}
+        base = empty_data()
         with open(fp, "w", encoding="utf-8") as f:
             json.dump(base, f, ensure_ascii=False, indent=2)
         return base
@@ -63,86 +124,1573 @@ def load_data() -> Dict[str, Any]:
         try:
             return json.load(f)
         except Exception:
-            return {"conversations": [], "transactions": [], "files": []}
+            return empty_data()
 
-def save_data(data: Dict[str, Any]) -> None:
-    fp = data_filepath()
-    with open(fp, "w", encoding="utf-8") as f:
+def save_data(data: Dict[str, Any], for_date: Optional[date] = None) -> None:
+    # 写临时文件 + fsync + 原子替换：写线程成批调用，代价由一批提交分摊
+    fp = data_filepath(for_date)
+    tmp = fp + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fp)
 
+# -------------------- 存储后端（整文件 / 追加日志 / SQLite） --------------------
+# 所有写入都以 op 表示：
+#   {"op":"add",  "kind":"transactions|conversations|files", "rec":{...}}
+#   {"op":"del",  "kind":"transactions", "id":...}                 # tombstone
+#   {"op":"edit", "kind":"transactions", "id":..., "data":{...}}   # 合并到 rec["data"]
+#   {"op":"unset","kind":"transactions", "id":..., "fields":[...]} # 删掉记录顶层字段（归档 source_text 用）
 
-NUMBER_RE = re.compile(r'(?P<num>\d{1,3}(?:[ \u00A0,]\d{3})*(?:[.,]\d+)?|\d+(?:[.,]\d+)?\s*[kкKК]?)')
+def add_op(kind: str, rec: Dict[str, Any]) -> Dict[str, Any]:
+    return {"op": "add", "kind": kind, "rec": rec}
 
-def normalize_number_token(tok: str) -> Optional[float]:
-    if not tok:
-        return None
-    s = tok.strip().replace("\u00A0", "").replace(" ", "").replace(",", ".")
-    mult = 1
-    if s and s[-1].lower() in ("k", "к"):
-        mult = 1000
-        s = s[:-1]
+def del_op(user_id: int, tx_id: str) -> Dict[str, Any]:
+    return {"op": "del", "kind": "transactions", "id": tx_id, "user_id": user_id}
+
+def edit_op(user_id: int, tx_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {"op": "edit", "kind": "transactions", "id": tx_id, "user_id": user_id, "data": fields}
+
+def unset_op(user_id: int, tx_id: str, fields: List[str]) -> Dict[str, Any]:
+    return {"op": "unset", "kind": "transactions", "id": tx_id, "user_id": user_id, "fields": fields}
+
+class RecordBatch:
+    """
+    一批 op 对同一个记录列表的写入：id -> 记录的映射在第一次删改时建一次，删除先记下、finish() 时统一过滤，
+    整批代价 O(记录数 + op 数)，而不是每个 op 扫一遍列表。id 重复时以最新（靠后）的一条为准。
+    """
+
+    __slots__ = ("recs", "_by_id", "_drop")
+
+    def __init__(self, recs: List[Dict[str, Any]]):
+        self.recs = recs
+        self._by_id: Optional[Dict[Any, Dict[str, Any]]] = None
+        self._drop: set = set()
+
+    def add(self, rec: Dict[str, Any]) -> None:
+        self.recs.append(rec)
+        if self._by_id is not None:
+            self._by_id[rec.get("id")] = rec
+
+    def apply(self, op: Dict[str, Any]) -> bool:
+        """执行 del / edit / unset，返回是否找到。"""
+        if self._by_id is None:
+            self._by_id = {r.get("id"): r for r in self.recs}
+        r = self._by_id.get(op["id"])
+        if r is None:
+            return False
+        if op["op"] == "del":
+            del self._by_id[op["id"]]
+            self._drop.add(id(r))
+        elif op["op"] == "edit":
+            r.setdefault("data", {}).update(op["data"])
+        elif op["op"] == "unset":
+            for k in op["fields"]:
+                r.pop(k, None)
+        return True
+
+    def finish(self) -> None:
+        if self._drop:
+            self.recs[:] = [r for r in self.recs if id(r) not in self._drop]
+            self._drop.clear()
+
+def record_month(rec: Dict[str, Any]) -> str:
+    o = tx_ordinal(rec)
+    return date.fromordinal(o).isoformat()[:7] if o else "unknown"
+
+class BaseStore:
+    """
+    存储后端接口：load() 返回完整文档，apply(ops) 原子地写入一批 op；
+    按用户读取的方法默认基于 load() 实现，带索引的后端应覆盖它们。
+    """
+
+    def load(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def transactions_for(self, user_id: int) -> List[Dict[str, Any]]:
+        return [t for t in self.load().get("transactions", []) if t.get("user_id") == user_id]
+
+    def files_for(self, user_id: int) -> List[Dict[str, Any]]:
+        return [f for f in self.load().get("files", []) if f.get("user_id") == user_id]
+
+    def archive_candidates(self, before: date) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """早于 before 的 (对话记录, 仍带 source_text 的交易)；按时间戳的日期部分比较。"""
+        data, cut = self.load(), before.isoformat()
+        convs = [c for c in data.get("conversations", []) if (c.get("timestamp") or "")[:10] < cut]
+        txs = [t for t in data.get("transactions", []) if t.get("source_text") is not None and (t.get("timestamp") or "")[:10] < cut]
+        return convs, txs
+
+class JsonStore(BaseStore):
+    """
+    single / daily 模式：每次写入都重写整个 JSON 文件。
+    daily 模式下新记录写进其账目日期（见 tx_ordinal）所在的日文件，读取时合并所有日文件，删改从最新的日文件往回找。
+    """
+
+    def load(self) -> Dict[str, Any]:
+        if SAVE_MODE != "daily":
+            return load_data()
+        merged = empty_data()
+        for d in daily_dates():
+            for kind, recs in load_data(d).items():
+                merged.setdefault(kind, []).extend(recs)
+        return merged
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        daily = SAVE_MODE == "daily"
+        touched: Dict[Optional[date], Dict[str, Any]] = {}
+        batches: Dict[Tuple[Optional[date], str], RecordBatch] = {}
+        days = sorted(daily_dates()) if daily else [None]   # 删改时从最新的日文件往回找
+
+        def batch(d: Optional[date], kind: str) -> RecordBatch:
+            b = batches.get((d, kind))
+            if b is None:
+                if d not in touched:
+                    touched[d] = load_data(d)
+                b = batches[(d, kind)] = RecordBatch(touched[d].setdefault(kind, []))
+            return b
+
+        for op in ops:
+            if op["op"] == "add":
+                o = tx_ordinal(op["rec"]) if daily else None
+                d = date.fromordinal(o) if o else (date.today() if daily else None)
+                if d not in days:
+                    bisect.insort(days, d)
+                batch(d, op["kind"]).add(op["rec"])
+                continue
+            for d in reversed(days):
+                if batch(d, op["kind"]).apply(op):
+                    break
+        for b in batches.values():
+            b.finish()
+        for d, data in touched.items():
+            save_data(data, d)
+
+class JournalStore(BaseStore):
+    """
+    journal 模式：快照 (finance_data.json) + 追加写的 JSONL 日志。
+    写入只追加 op 行并 fsync，代价与记录大小成正比，而不是与整个库成正比；
+    启动时读快照并重放日志，末尾被截断的行会被丢弃；日志超过阈值时压缩成新快照。
+    重放是幂等的（按 id 覆盖/删除），所以压缩中途崩溃也不会产生重复记录。
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str, compact_every: int = JOURNAL_COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._state: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None
+        self._journal_lines = 0
+        self._fh = None
+
+    @staticmethod
+    def _apply_op(state: Dict[str, Dict[str, Dict[str, Any]]], op: Dict[str, Any]) -> None:
+        recs = state.setdefault(op.get("kind", "transactions"), {})
+        if op["op"] == "add":
+            rec = op["rec"]
+            recs[rec.get("id") or str(uuid.uuid4())] = rec
+        elif op["op"] == "del":
+            recs.pop(op["id"], None)
+        elif op["op"] == "edit":
+            rec = recs.get(op["id"])
+            if rec is not None:
+                rec.setdefault("data", {}).update(op["data"])
+        elif op["op"] == "unset":
+            rec = recs.get(op["id"])
+            if rec is not None:
+                for k in op["fields"]:
+                    rec.pop(k, None)
+
+    def _ensure_loaded(self) -> None:
+        if self._state is not None:
+            return
+        state: Dict[str, Dict[str, Dict[str, Any]]] = {k: {} for k in DATA_KINDS}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                try:
+                    snap = json.load(f)
+                except Exception:
+                    snap = empty_data()
+            for kind in DATA_KINDS:
+                for rec in snap.get(kind, []):
+                    state[kind][rec.get("id") or str(uuid.uuid4())] = rec
+        lines = 0
+        if os.path.exists(self.journal_path):
+            good = 0
+            with open(self.journal_path, "rb") as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break   # 崩溃时写了一半的最后一行
+                    try:
+                        op = json.loads(raw)
+                    except ValueError:
+                        break
+                    self._apply_op(state, op)
+                    good += len(raw)
+                    lines += 1
+            if good < os.path.getsize(self.journal_path):
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(good)
+        self._state = state
+        self._journal_lines = lines
+        self._fh = open(self.journal_path, "ab")
+
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            self._ensure_loaded()
+            return {k: list(v.values()) for k, v in self._state.items()}
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        if not ops:
+            return
+        with self._lock:
+            self._ensure_loaded()
+            payload = b"".join(json.dumps(op, ensure_ascii=False).encode("utf-8") + b"\n" for op in ops)
+            self._fh.write(payload)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            for op in ops:
+                self._apply_op(self._state, op)
+            self._journal_lines += len(ops)
+            if self._journal_lines >= self.compact_every:
+                self.compact()
+
+    def compact(self) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({k: list(v.values()) for k, v in self._state.items()}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            self._fh.close()
+            self._fh = open(self.journal_path, "wb")
+            self._journal_lines = 0
+
+class SqliteStore(BaseStore):
+    """
+    sqlite 模式：WAL 日志 + (user_id, day)、(user_id, id) 索引，按用户/日期的查询走索引，
+    每批 op 一个事务。每条记录完整保存在 doc 列（JSON），常用字段单独成列以便建索引。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL：每次提交都 fsync WAL。写线程的 Future 在提交后才 resolve，对调用方就是“已落盘”；
+        # NORMAL 下断电会丢掉已确认的批次。fsync 的代价由 GroupWriter 的批量提交摊薄
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    user_id INTEGER,
+                    day INTEGER,
+                    doc TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_tx_user_day ON transactions(user_id, day);
+                CREATE INDEX IF NOT EXISTS ix_tx_user_id ON transactions(user_id, id);
+                CREATE INDEX IF NOT EXISTS ix_tx_user_seq ON transactions(user_id, seq);
+                CREATE TABLE IF NOT EXISTS conversations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    user_id INTEGER,
+                    doc TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    user_id INTEGER,
+                    doc TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_files_user ON files(user_id, seq);
+            """)
+
+    @staticmethod
+    def _row(kind: str, rec: Dict[str, Any]) -> Tuple:
+        rec_id = rec.get("id") or str(uuid.uuid4())
+        doc = json.dumps(rec, ensure_ascii=False)
+        if kind == "transactions":
+            return (rec_id, rec.get("user_id"), tx_ordinal(rec), doc)
+        return (rec_id, rec.get("user_id"), doc)
+
+    def insert_many(self, kind: str, recs: List[Dict[str, Any]]) -> None:
+        """批量插入（迁移用），调用方负责事务。"""
+        if kind == "transactions":
+            sql = "INSERT OR REPLACE INTO transactions (id, user_id, day, doc) VALUES (?, ?, ?, ?)"
+        else:
+            sql = f"INSERT OR REPLACE INTO {kind} (id, user_id, doc) VALUES (?, ?, ?)"
+        self._conn.executemany(sql, [self._row(kind, r) for r in recs])
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        if not ops:
+            return
+        with self._lock, self._conn:
+            for op in ops:
+                kind = op.get("kind", "transactions")
+                if kind not in DATA_KINDS:
+                    continue
+                if op["op"] == "add":
+                    self.insert_many(kind, [op["rec"]])
+                elif op["op"] == "del":
+                    self._conn.execute(f"DELETE FROM {kind} WHERE id = ?", (op["id"],))
+                elif op["op"] in ("edit", "unset"):
+                    row = self._conn.execute(f"SELECT doc FROM {kind} WHERE id = ?", (op["id"],)).fetchone()
+                    if row:
+                        rec = json.loads(row[0])
+                        if op["op"] == "edit":
+                            rec.setdefault("data", {}).update(op["data"])
+                        else:
+                            for k in op["fields"]:
+                                rec.pop(k, None)
+                        if kind == "transactions":
+                            self._conn.execute("UPDATE transactions SET doc = ?, day = ? WHERE id = ?",
+                                               (json.dumps(rec, ensure_ascii=False), tx_ordinal(rec), op["id"]))
+                        else:
+                            self._conn.execute(f"UPDATE {kind} SET doc = ? WHERE id = ?", (json.dumps(rec, ensure_ascii=False), op["id"]))
+
+    def _docs(self, sql: str, params: Tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [json.loads(r[0]) for r in self._conn.execute(sql, params)]
+
+    def load(self) -> Dict[str, Any]:
+        return {k: self._docs(f"SELECT doc FROM {k} ORDER BY seq") for k in DATA_KINDS}
+
+    def transactions_for(self, user_id: int) -> List[Dict[str, Any]]:
+        return self._docs("SELECT doc FROM transactions WHERE user_id = ? ORDER BY day, seq", (user_id,))
+
+    def files_for(self, user_id: int) -> List[Dict[str, Any]]:
+        return self._docs("SELECT doc FROM files WHERE user_id = ? ORDER BY seq", (user_id,))
+
+    def archive_candidates(self, before: date) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        convs = self._docs("SELECT doc FROM conversations WHERE substr(json_extract(doc, '$.timestamp'), 1, 10) < ? ORDER BY seq",
+                           (before.isoformat(),))
+        # day 列是账目日期；保留期按消息写入时间算
+        txs = self._docs("SELECT doc FROM transactions WHERE substr(json_extract(doc, '$.timestamp'), 1, 10) < ? "
+                         "AND json_extract(doc, '$.source_text') IS NOT NULL ORDER BY seq", (before.isoformat(),))
+        return convs, txs
+
+class ShardedStore(BaseStore):
+    """
+    sharded 模式：按 user_id 分片。每个用户一个目录 shards/<哈希桶>/<user_id>/，里面有
+    manifest.json（该用户有哪些月份分区）、tx-YYYY-MM.json、conv-YYYY-MM.json 和 files.json。
+    一条消息的读写只打开调用者自己的目录和所需的月份分区，代价与用户总数、历史总量无关。
+    分区文件写临时文件 + fsync + 原子替换；先写 manifest 再写分区，崩溃时最多留下一个空分区名。
+    删改按 op 里的 user_id 定位分片，带 month 时直接去对应月份分区，否则从最新的分区往回找。
+    """
+
+    PREFIX = {"transactions": "tx", "conversations": "conv"}
+
+    def __init__(self, root: str, buckets: int = SHARD_BUCKETS, cache_partitions: int = SHARD_CACHE_PARTITIONS):
+        self.root = root
+        self.buckets = buckets
+        self.cache_partitions = cache_partitions
+        self._lock = threading.RLock()
+        self._cache: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._manifests: Dict[Any, Dict[str, List[str]]] = {}
+
+    def user_dir(self, user_id) -> str:
+        bucket = int(hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:8], 16) % self.buckets
+        return os.path.join(self.root, f"{bucket:03d}", str(user_id))
+
+    def _path(self, user_id, kind: str, month: Optional[str] = None) -> str:
+        name = "files.json" if kind == "files" else f"{self.PREFIX[kind]}-{month}.json"
+        return os.path.join(self.user_dir(user_id), name)
+
+    @staticmethod
+    def _write_json(path: str, obj: Any) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _manifest(self, user_id) -> Dict[str, List[str]]:
+        man = self._manifests.get(user_id)
+        if man is None:
+            path = os.path.join(self.user_dir(user_id), "manifest.json")
+            man = {"transactions": [], "conversations": []}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    man.update(json.load(f).get("partitions", {}))
+            self._manifests[user_id] = man
+        return man
+
+    def _read(self, path: str) -> List[Dict[str, Any]]:
+        recs = self._cache.get(path)
+        if recs is not None:
+            self._cache.move_to_end(path)
+            return recs
+        recs = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                recs = json.load(f)
+        self._cache[path] = recs
+        while len(self._cache) > self.cache_partitions:
+            self._cache.popitem(last=False)
+        return recs
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        if not ops:
+            return
+        with self._lock:
+            dirty: Dict[str, RecordBatch] = {}
+            dirty_users: set = set()
+
+            def part(path: str) -> RecordBatch:
+                if path not in dirty:
+                    dirty[path] = RecordBatch(self._read(path))
+                return dirty[path]
+
+            try:
+                for op in ops:
+                    kind = op.get("kind", "transactions")
+                    if kind not in DATA_KINDS:
+                        continue
+                    if op["op"] == "add":
+                        rec = op["rec"]
+                        uid = rec.get("user_id")
+                        month = None
+                        if kind != "files":
+                            month = record_month(rec)
+                            months = self._manifest(uid)[kind]
+                            if month not in months:
+                                bisect.insort(months, month)
+                                dirty_users.add(uid)
+                        part(self._path(uid, kind, month)).add(rec)
+                        continue
+                    uid = op.get("user_id")
+                    if kind == "files":
+                        candidates = [None]
+                    elif op.get("month"):
+                        candidates = [op["month"]]
+                    else:
+                        candidates = list(reversed(self._manifest(uid)[kind]))
+                    for month in candidates:
+                        if part(self._path(uid, kind, month)).apply(op):
+                            break
+                for uid in dirty_users:
+                    self._write_json(os.path.join(self.user_dir(uid), "manifest.json"),
+                                     {"user_id": uid, "partitions": self._manifest(uid)})
+                for path, b in dirty.items():
+                    b.finish()
+                    self._write_json(path, b.recs)
+            except Exception:
+                # 缓存里的分区可能已被改了一半：丢掉，下次从磁盘重读
+                for path in dirty:
+                    self._cache.pop(path, None)
+                for uid in dirty_users:
+                    self._manifests.pop(uid, None)
+                raise
+
+    def _partitions(self, user_id, kind: str, months: List[str]) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for month in months:
+            out.extend(self._read(self._path(user_id, kind, month)))
+        return out
+
+    def transactions_for(self, user_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._partitions(user_id, "transactions", self._manifest(user_id)["transactions"])
+
+    def files_for(self, user_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._read(self._path(user_id, "files")))
+
+    def _user_ids(self) -> List[Any]:
+        out = []
+        if os.path.isdir(self.root):
+            for bucket in sorted(os.listdir(self.root)):
+                for name in sorted(os.listdir(os.path.join(self.root, bucket))):
+                    out.append(int(name) if name.lstrip("-").isdigit() else name)
+        return out
+
+    def load(self) -> Dict[str, Any]:
+        # 全量读取只给迁移 / 维护任务用，消息处理路径不会走到这里
+        data = empty_data()
+        with self._lock:
+            for uid in self._user_ids():
+                man = self._manifest(uid)
+                data["transactions"].extend(self._partitions(uid, "transactions", man["transactions"]))
+                data["conversations"].extend(self._partitions(uid, "conversations", man["conversations"]))
+                data["files"].extend(self._read(self._path(uid, "files")))
+        return data
+
+    def archive_candidates(self, before: date) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        cut, cut_month = before.isoformat(), before.isoformat()[:7]
+        convs: List[Dict[str, Any]] = []
+        txs: List[Dict[str, Any]] = []
+        with self._lock:
+            for uid in self._user_ids():
+                man = self._manifest(uid)
+                for c in self._partitions(uid, "conversations", [mo for mo in man["conversations"] if mo <= cut_month]):
+                    if (c.get("timestamp") or "")[:10] < cut:
+                        convs.append(c)
+                # 交易分区按账目日期分月，和写入时间无关，只能全看
+                for t in self._partitions(uid, "transactions", man["transactions"]):
+                    if t.get("source_text") is not None and (t.get("timestamp") or "")[:10] < cut:
+                        txs.append(t)
+        return convs, txs
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_store():
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            if SAVE_MODE == "journal":
+                _STORE = JournalStore(DEFAULT_DATA_FILE, JOURNAL_FILE)
+            elif SAVE_MODE == "sqlite":
+                _STORE = SqliteStore(SQLITE_FILE)
+            elif SAVE_MODE == "sharded":
+                _STORE = ShardedStore(SHARD_DIR)
+            else:
+                _STORE = JsonStore()
+        return _STORE
+
+# -------------------- JSON -> SQLite 一次性迁移 --------------------
+def iter_json_arrays(path: str, chunk_size: int = 1 << 16):
+    """
+    流式遍历 {"key": [item, ...], ...} 形式的 JSON 文件，逐个产出 (key, item)，
+    内存只保留当前读缓冲区和当前 item，不把整个文件读进来。
+    """
+    dec = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill() -> None:
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def peek() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if eof:
+                    return ""
+                fill()
+
+        def decode() -> Any:
+            nonlocal pos
+            while True:
+                try:
+                    obj, end = dec.raw_decode(buf, pos)
+                    if end < len(buf) or eof:   # 数值可能在缓冲区末尾被截断
+                        pos = end
+                        return obj
+                except ValueError:
+                    if eof:
+                        raise
+                fill()
+
+        if peek() != "{":
+            raise ValueError(f"{path}: expected a JSON object")
+        pos += 1
+        while peek() not in ("}", ""):
+            key = decode()
+            if peek() != ":":
+                raise ValueError(f"{path}: expected ':' after {key!r}")
+            pos += 1
+            if peek() != "[":
+                decode()   # 非数组字段直接跳过
+            else:
+                pos += 1
+                while peek() not in ("]", ""):
+                    yield key, decode()
+                    if peek() == ",":
+                        pos += 1
+                pos += 1
+            if peek() == ",":
+                pos += 1
+
+def migrate_json_to_sqlite(json_path: str = DEFAULT_DATA_FILE, db_path: str = SQLITE_FILE,
+                           journal_path: Optional[str] = JOURNAL_FILE, batch: int = 1000) -> Dict[str, int]:
+    """把 finance_data.json（以及 journal 模式留下的日志）流式导入 SQLite，返回各类记录数。"""
+    store = SqliteStore(db_path)
+    counts = {k: 0 for k in DATA_KINDS}
+    pending: Dict[str, List[Dict[str, Any]]] = {k: [] for k in DATA_KINDS}
+
+    def flush(kind: str) -> None:
+        with store._conn:
+            store.insert_many(kind, pending[kind])
+        counts[kind] += len(pending[kind])
+        pending[kind] = []
+
+    if os.path.exists(json_path):
+        for kind, rec in iter_json_arrays(json_path):
+            if kind not in pending or not isinstance(rec, dict):
+                continue
+            pending[kind].append(rec)
+            if len(pending[kind]) >= batch:
+                flush(kind)
+        for kind in DATA_KINDS:
+            if pending[kind]:
+                flush(kind)
+    if journal_path and os.path.exists(journal_path):
+        ops = []
+        with open(journal_path, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                ops.append(json.loads(raw))
+                if len(ops) >= batch:
+                    store.apply(ops)
+                    ops = []
+        store.apply(ops)
+    return counts
+
+# -------------------- 常驻索引：user_id -> 按日期排序的交易 --------------------
+def tx_ordinal(rec: Dict[str, Any]) -> Optional[int]:
+    """
+    记录归到哪一天：交易按账目日期 data.date（导入的对账单是历史日期，不能算到导入那天），
+    没有或解析不了时退回写入时间戳；对话记录只有时间戳。索引、汇总、列视图和分区都按它。
+    """
+    d = (rec.get("data") or {}).get("date")
+    if d:
+        try:
+            return date.fromisoformat(str(d)[:10]).toordinal()
+        except ValueError:
+            pass
     try:
-        return float(s) * mult
-    except:
+        return datetime.fromisoformat(rec.get("timestamp")).date().toordinal()
+    except Exception:
         return None
 
-def find_numbers_with_positions(text: str) -> List[Tuple[float,int,int,str]]:
-    res = []
-    for m in NUMBER_RE.finditer(text):
-        raw = m.group("num")
-        val = normalize_number_token(raw)
-        if val is not None:
-            res.append((val, m.start(), m.end(), raw))
-    # fallback: try simple digits
-    if not res:
-        for m in re.finditer(r'(\d+(?:[.,]\d+)?)', text):
+def month_key(ordinal: int) -> int:
+    d = date.fromordinal(ordinal)
+    return d.year * 12 + d.month - 1
+
+class Rollups:
+    """(user, 日) 与 (user, 月) 两级的收入/支出汇总，由 TxIndex 增量维护。"""
+
+    def __init__(self):
+        self.day: Dict[Tuple[int, int], List[float]] = {}     # (user_id, ordinal) -> [inc, exp]
+        self.month: Dict[Tuple[int, int], List[float]] = {}   # (user_id, month_key) -> [inc, exp]
+
+    def add(self, user_id: int, ordinal: int, d: Dict[str, Any], sign: int = 1) -> None:
+        try:
+            amt = float(d.get("amount", 0)) * sign
+        except (TypeError, ValueError):
+            return
+        slot = 0 if d.get("type") == "income" else 1
+        self.day.setdefault((user_id, ordinal), [0.0, 0.0])[slot] += amt
+        self.month.setdefault((user_id, month_key(ordinal)), [0.0, 0.0])[slot] += amt
+
+    def totals(self, user_id: int, start_date: date, end_date: date) -> Tuple[float, float]:
+        # 整月用月汇总，首尾不完整的月份逐日累加：一年最多约 12 + 31 次查找
+        inc = 0.0; exp = 0.0
+        o = start_date.toordinal()
+        last = end_date.toordinal()
+        while o <= last:
+            d = date.fromordinal(o)
+            if d.day == 1:
+                nxt = date(d.year + d.month // 12, d.month % 12 + 1, 1).toordinal()
+                if nxt - 1 <= last:
+                    b = self.month.get((user_id, d.year * 12 + d.month - 1))
+                    if b:
+                        inc += b[0]; exp += b[1]
+                    o = nxt
+                    continue
+            b = self.day.get((user_id, o))
+            if b:
+                inc += b[0]; exp += b[1]
+            o += 1
+        return inc, exp
+
+class TxIndex:
+    """
+    每个用户一份按日期序数排序的交易列表（ords 与 recs 平行），用户首次被查询时
+    从存储加载一次（只读该用户的记录），之后由 commit_ops() 同步。区间查询用二分查找，代价与命中的行数成正比。
+    同时维护日/月汇总（Rollups），区间合计不必逐行累加。
+    另有每个用户按写入先后排列的 id 队列（recent），取 / 删最后 N 条只碰队尾 N 个元素。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded: set = set()
+        self.rollups = Rollups()
+        self._ords: Dict[int, List[int]] = {}
+        self._recs: Dict[int, List[Dict[str, Any]]] = {}
+        self._where: Dict[str, Tuple[int, int]] = {}   # tx_id -> (user_id, ordinal)
+        self._fps: Dict[int, set] = {}                 # user_id -> 已导入行的指纹
+        self._recent: Dict[int, deque] = {}            # user_id -> 按写入先后的 tx_id，队尾最新
+
+    def _ensure(self, user_id: int) -> None:
+        if user_id in self._loaded:
+            return
+        # 存储按日期返回；按时间戳稳定排序还原写入先后
+        for rec in sorted(get_store().transactions_for(user_id), key=lambda r: r.get("timestamp") or ""):
+            self._add(rec)
+        self._loaded.add(user_id)
+
+    def _add(self, rec: Dict[str, Any]) -> None:
+        o = tx_ordinal(rec)
+        if o is None or rec.get("id") in self._where:
+            return
+        # 自己留一份：journal / sharded 存储会把同一个 dict 交给索引，edit 落盘时已经改过它，
+        # 之后 _edit 再按“旧值”回滚汇总就会抵消
+        rec = dict(rec, data=dict(rec.get("data") or {}))
+        uid = rec.get("user_id")
+        ords = self._ords.setdefault(uid, [])
+        recs = self._recs.setdefault(uid, [])
+        i = bisect.bisect_right(ords, o)
+        ords.insert(i, o)
+        recs.insert(i, rec)
+        self._where[rec.get("id")] = (uid, o)
+        self.rollups.add(uid, o, rec.get("data", {}))
+        if rec.get("fp"):
+            self._fps.setdefault(uid, set()).add(rec["fp"])
+        self._recent.setdefault(uid, deque()).append(rec.get("id"))
+
+    def _locate(self, tx_id: str) -> Optional[Tuple[int, int]]:
+        loc = self._where.get(tx_id)
+        if loc is None:
+            return None
+        uid, o = loc
+        ords, recs = self._ords[uid], self._recs[uid]
+        for i in range(bisect.bisect_left(ords, o), bisect.bisect_right(ords, o)):
+            if recs[i].get("id") == tx_id:
+                return uid, i
+        return None
+
+    def _remove(self, tx_id: str) -> None:
+        pos = self._locate(tx_id)
+        if pos is None:
+            return
+        uid, i = pos
+        self.rollups.add(uid, self._ords[uid][i], self._recs[uid][i].get("data", {}), sign=-1)
+        self._fps.get(uid, set()).discard(self._recs[uid][i].get("fp"))
+        recent = self._recent[uid]
+        if recent and recent[-1] == tx_id:
+            recent.pop()   # 常见情况：删的就是最新的一条
+        else:
+            recent.remove(tx_id)
+        del self._ords[uid][i]
+        del self._recs[uid][i]
+        del self._where[tx_id]
+
+    def _edit(self, tx_id: str, fields: Dict[str, Any]) -> None:
+        pos = self._locate(tx_id)
+        if pos is not None and "date" in fields:
+            # 改了账目日期：挪到新的日期位置，写入先后（recent）不变
+            uid, i = pos
+            rec = dict(self._recs[uid][i], data=dict(self._recs[uid][i].get("data") or {}, **fields))
+            recent = list(self._recent[uid])
+            self._remove(tx_id)
+            self._add(rec)
+            self._recent[uid] = deque(recent)
+            return
+        if pos is not None:
+            uid, i = pos
+            o, d = self._ords[uid][i], self._recs[uid][i].setdefault("data", {})
+            self.rollups.add(uid, o, d, sign=-1)
+            d.update(fields)
+            self.rollups.add(uid, o, d)
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            # 未加载的用户跳过：首次查询时会从存储读到这些写入
+            for op in ops:
+                if op.get("kind") != "transactions":
+                    continue
+                if op["op"] == "add":
+                    if op["rec"].get("user_id") in self._loaded:
+                        self._add(op["rec"])
+                elif op["op"] == "del":
+                    self._remove(op["id"])
+                elif op["op"] == "edit":
+                    self._edit(op["id"], op["data"])
+                elif op["op"] == "unset":
+                    pos = self._locate(op["id"])
+                    if pos is not None:
+                        for k in op["fields"]:
+                            self._recs[pos[0]][pos[1]].pop(k, None)
+
+    def records(self, user_id: int) -> List[Dict[str, Any]]:
+        """该用户的全部交易（按日期），首次调用时加载。"""
+        with self._lock:
+            self._ensure(user_id)
+            return list(self._recs.get(user_id, ()))
+
+    def range(self, user_id: int, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._ensure(user_id)
+            ords = self._ords.get(user_id)
+            if not ords:
+                return []
+            lo = bisect.bisect_left(ords, start_date.toordinal())
+            hi = bisect.bisect_right(ords, end_date.toordinal())
+            return self._recs[user_id][lo:hi]
+
+    def totals(self, user_id: int, start_date: date, end_date: date) -> Tuple[float, float]:
+        with self._lock:
+            self._ensure(user_id)
+            return self.rollups.totals(user_id, start_date, end_date)
+
+    def last(self, user_id: int, n: int) -> List[Dict[str, Any]]:
+        """最近写入的 n 条（最新在前），代价 O(n)。"""
+        with self._lock:
+            self._ensure(user_id)
+            out = []
+            for tx_id in reversed(self._recent.get(user_id, ())):
+                if len(out) >= n:
+                    break
+                pos = self._locate(tx_id)
+                if pos is not None:
+                    out.append(self._recs[pos[0]][pos[1]])
+            return out
+
+    def has_fingerprint(self, user_id: int, fp: str) -> bool:
+        with self._lock:
+            self._ensure(user_id)
+            return fp in self._fps.get(user_id, ())
+
+TX_INDEX = TxIndex()
+
+FILE_TOKEN_RE = re.compile(r'[^\W_]{2,}')
+FILE_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def file_tokens(text: str) -> set:
+    """
+    参与重合匹配的词元：纯数字（年份、日期片段、金额）不算，否则“export 2025-10-04”会撞上 bank_2025.xlsx，
+    日期导出永远走不到；数字只通过完整文件名或日期匹配起作用。
+    """
+    return {tok for tok in FILE_TOKEN_RE.findall(text) if not tok.isdigit()}
+
+class UserFiles:
+    __slots__ = ("files", "stems", "ids", "by_token", "by_name", "name_lens", "by_date")
+
+    def __init__(self):
+        self.files: List[Dict[str, Any]] = []       # 按上传顺序，下标越大越新
+        self.stems: List[str] = []                  # 与 files 对齐的小写主名，子串兜底用
+        self.ids: set = set()                       # 已收录的文件 id，加载和 apply 交错时去重
+        self.by_token: Dict[str, List[int]] = {}    # 文件名词元 -> 下标
+        self.by_name: Dict[str, List[int]] = {}     # 小写完整文件名 -> 下标
+        self.name_lens: Dict[int, int] = {}         # 完整文件名长度 -> 个数
+        self.by_date: Dict[str, List[int]] = {}     # 上传日期 YYYY-MM-DD -> 下标
+
+class FileCatalog:
+    """
+    上传文件目录：每个用户一份有序列表 + 文件名词元倒排索引 + 日期映射，首次查询时加载，之后由 commit_ops() 同步。
+    查找只碰命中的条目；排序固定为：完整文件名 > 日期 > 词元重合数 > 上传先后，
+    一个词元都没重合时才逐个看主名是否包含消息里的词（与旧版的子串匹配一致）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users: Dict[int, UserFiles] = {}
+
+    def _ensure(self, user_id: int) -> UserFiles:
+        uf = self._users.get(user_id)
+        if uf is None:
+            uf = self._users[user_id] = UserFiles()
+            for f in get_store().files_for(user_id):
+                self._add(uf, f)
+        return uf
+
+    @staticmethod
+    def _add(uf: UserFiles, f: Dict[str, Any]) -> None:
+        # 首次加载读盘时并发提交的文件可能既在盘上又经 apply() 到达，按 id 只收一次
+        fid = f.get("id")
+        if fid is not None:
+            if fid in uf.ids:
+                return
+            uf.ids.add(fid)
+        i = len(uf.files)
+        uf.files.append(f)
+        full = (f.get("filename") or "").lower()
+        if full:
+            uf.by_name.setdefault(full, []).append(i)
+            uf.name_lens[len(full)] = uf.name_lens.get(len(full), 0) + 1
+        # 只取主名：扩展名（xlsx/csv）是用户选导出格式时会说的词，不用来认文件
+        name = os.path.splitext(full)[0]
+        uf.stems.append(name)
+        for tok in file_tokens(name):
+            uf.by_token.setdefault(tok, []).append(i)
+        uf.by_date.setdefault((f.get("timestamp") or "")[:10], []).append(i)
+
+    @staticmethod
+    def _named(uf: UserFiles, low: str) -> List[int]:
+        """消息里出现的完整文件名：按已有文件名的长度切片查表，和词元切分无关（“把账单.xlsx发给我”）。"""
+        hits: List[int] = []
+        for n in uf.name_lens:
+            for start in range(len(low) - n + 1):
+                hits.extend(uf.by_name.get(low[start:start + n], ()))
+        return hits
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            for op in ops:
+                if op.get("kind") == "files" and op["op"] == "add":
+                    uf = self._users.get(op["rec"].get("user_id"))
+                    if uf is not None:
+                        self._add(uf, op["rec"])
+
+    def find(self, user_id: int, text: str) -> Optional[Dict[str, Any]]:
+        low = text.lower()
+        tokens = file_tokens(low)
+        with self._lock:
+            uf = self._ensure(user_id)
+            # 词元倒排表给出候选：{下标: 重合的词元数}
+            overlap: Dict[int, int] = {}
+            for tok in tokens:
+                for i in uf.by_token.get(tok, ()):
+                    overlap[i] = overlap.get(i, 0) + 1
+            # 1) 消息里包含完整文件名
+            exact = self._named(uf, low)
+            if exact:
+                return uf.files[max(exact)]
+            # 2) 消息里的显式日期
+            for d in FILE_DATE_RE.findall(low):
+                hits = uf.by_date.get(d)
+                if hits:
+                    return uf.files[hits[-1]]
+            # 3) 词元重合数，其次最近上传
+            if overlap:
+                return uf.files[max(overlap, key=lambda i: (overlap[i], i))]
+            # 4) 子串兜底：主名包含消息里的词（statement -> statements.xlsx），最近上传优先
+            for i in range(len(uf.files) - 1, -1, -1):
+                if any(tok in uf.stems[i] for tok in tokens):
+                    return uf.files[i]
+            return None
+
+FILE_CATALOG = FileCatalog()
+
+class DataVersions:
+    """每个用户的交易数据版本号：任何增删改都会加一，导出缓存据此判断是否过期（仅进程内有效）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[int, int] = {}
+
+    def get(self, user_id: int) -> int:
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, ops: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            for op in ops:
+                if op.get("kind") != "transactions" or op["op"] == "unset":
+                    continue   # unset 只搬走 source_text，不影响导出内容
+                uid = op["rec"].get("user_id") if op["op"] == "add" else op.get("user_id")
+                self._versions[uid] = self._versions.get(uid, 0) + 1
+
+DATA_VERSIONS = DataVersions()
+
+def commit_ops(ops: List[Dict[str, Any]]) -> None:
+    """所有写入的唯一入口：先落盘，再同步内存索引和数据版本。"""
+    if not ops:
+        return
+    get_store().apply(ops)
+    TX_INDEX.apply(ops)
+    ANALYTICS.apply(ops)
+    FILE_CATALOG.apply(ops)
+    DATA_VERSIONS.bump(ops)
+
+class UndoLog:
+    """每个用户的多步撤销 / 重做栈，每一步是 (正向 op, 逆向 op)；只在进程内保存。"""
+
+    def __init__(self, depth: int = UNDO_DEPTH):
+        self.depth = depth
+        self._stacks: Dict[int, Tuple[deque, deque]] = {}
+
+    def _user(self, user_id: int) -> Tuple[deque, deque]:
+        if user_id not in self._stacks:
+            self._stacks[user_id] = (deque(maxlen=self.depth), deque(maxlen=self.depth))
+        return self._stacks[user_id]
+
+    def record(self, user_id: int, forward: List[Dict[str, Any]], inverse: List[Dict[str, Any]]) -> None:
+        undo, redo = self._user(user_id)
+        undo.append((forward, inverse))
+        redo.clear()   # 新操作之后，之前撤销掉的步骤不能再重做
+
+    def peek(self, user_id: int, which: str) -> Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+        stack = self._user(user_id)[0 if which == "undo" else 1]
+        return stack[-1] if stack else None
+
+    def move(self, user_id: int, which: str) -> None:
+        """撤销：undo 栈顶移到 redo；重做：反过来。落盘成功后才调用。"""
+        undo, redo = self._user(user_id)
+        src, dst = (undo, redo) if which == "undo" else (redo, undo)
+        dst.append(src.pop())
+
+UNDO_LOG = UndoLog()
+
+class _WriteItem:
+    __slots__ = ("user_id", "ops", "build", "future")
+
+    def __init__(self, user_id, ops, build):
+        self.user_id = user_id
+        self.ops = ops
+        self.build = build
+        self.future: Future = Future()
+
+class GroupWriter:
+    """
+    唯一的写线程：处理函数把变更放进队列，拿到一个 Future，落盘后才 resolve。
+    写线程按提交顺序处理（同一用户的变更因此保持顺序），攒够 WRITE_BATCH_MAX 条或等满
+    WRITE_FLUSH_SECONDS 就用一次 commit_ops() 写完整批，一批只付一次 fsync / 事务。
+    “删除最后 N 条”“修改最后一条”“撤销 / 重做”这类需要读当前数据的变更由 build 在写线程里生成 op；
+    若本批里已有同一用户尚未落盘的写入，先把本批刷掉再读，保证看到的是最新状态。
+    build 可以多返回一个回调，在该批落盘成功后执行（用来记 UNDO_LOG）。
+    """
+
+    def __init__(self, max_batch: int = WRITE_BATCH_MAX, max_delay: float = WRITE_FLUSH_SECONDS):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[_WriteItem]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id: Optional[int], ops: Optional[List[Dict[str, Any]]] = None,
+               build: Optional[Callable[[], Tuple]] = None, result: Any = None,
+               after: Optional[Callable[[], None]] = None) -> Future:
+        """ops：直接写入的 op，Future 结果为 result；build：在写线程里调用，返回 (ops, 结果[, 落盘后回调])。"""
+        item = _WriteItem(user_id, ops, build)
+        if build is None:
+            item.build = lambda: (ops, result, after)
+        self._ensure_started()
+        self._queue.put(item)
+        return item.future
+
+    def append(self, user_id: int, ops: List[Dict[str, Any]], result: Any = None, undoable: bool = False) -> Future:
+        """undoable=True 时，其中的交易新增记为一步可撤销操作。"""
+        after = None
+        if undoable:
+            forward = [op for op in ops if op.get("kind") == "transactions"]
+            inverse = [del_op(user_id, op["rec"]["id"]) for op in reversed(forward)]
+            after = lambda: UNDO_LOG.record(user_id, forward, inverse)
+        return self.submit(user_id, ops, result=result, after=after)
+
+    def delete_last(self, user_id: int, n: int) -> Future:
+        """结果为实际删除的条数。"""
+        def build():
+            recs = TX_INDEX.last(user_id, n)
+            if not recs:
+                return [], 0
+            forward = [del_op(user_id, t["id"]) for t in recs]
+            # 撤销时从旧到新重新加回，保留完整记录（含 fp）
+            inverse = [add_op("transactions", copy.deepcopy(t)) for t in reversed(recs)]
+            return forward, len(forward), lambda: UNDO_LOG.record(user_id, forward, inverse)
+        return self.submit(user_id, build=build)
+
+    def edit_last(self, user_id: int, fields: Dict[str, Any]) -> Future:
+        """结果为是否找到了可修改的记录。"""
+        def build():
+            recs = TX_INDEX.last(user_id, 1)
+            if not recs:
+                return [], False
+            t = recs[0]
+            old = {k: t.get("data", {}).get(k) for k in fields}
+            forward = [edit_op(user_id, t["id"], dict(fields))]
+            inverse = [edit_op(user_id, t["id"], old)]
+            return forward, True, lambda: UNDO_LOG.record(user_id, forward, inverse)
+        return self.submit(user_id, build=build)
+
+    def undo(self, user_id: int, which: str = "undo") -> Future:
+        """which="undo" 撤销最近一步，"redo" 重做最近撤销的一步；结果为是否有可执行的步骤。"""
+        def build():
+            step = UNDO_LOG.peek(user_id, which)
+            if step is None:
+                return [], False
+            return (step[1] if which == "undo" else step[0]), True, lambda: UNDO_LOG.move(user_id, which)
+        return self.submit(user_id, build=build)
+
+    def redo(self, user_id: int) -> Future:
+        return self.undo(user_id, "redo")
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(items) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._process(items)
+
+    def _process(self, items: List[_WriteItem]) -> None:
+        ops: List[Dict[str, Any]] = []
+        done: List[Tuple[_WriteItem, Any, Optional[Callable[[], None]]]] = []
+        dirty: set = set()   # 本批中有未落盘写入的用户
+        for item in items:
+            if item.ops is None and item.user_id in dirty:
+                self._flush(ops, done)
+                ops, done, dirty = [], [], set()
             try:
-                res.append((float(m.group(1).replace(",", ".")), m.start(), m.end(), m.group(1)))
-            except:
+                out = item.build()
+            except Exception as e:
+                item.future.set_exception(e)
                 continue
-    return res
+            item_ops, result = out[0], out[1]
+            ops.extend(item_ops or [])
+            done.append((item, result, out[2] if len(out) > 2 else None))
+            if item_ops:
+                dirty.add(item.user_id)
+        self._flush(ops, done)
+
+    @staticmethod
+    def _flush(ops: List[Dict[str, Any]], done: List[Tuple[_WriteItem, Any, Optional[Callable[[], None]]]]) -> None:
+        try:
+            commit_ops(ops)
+        except Exception as e:
+            traceback.print_exc()
+            for item, _, _ in done:
+                item.future.set_exception(e)
+            return
+        for item, result, after in done:
+            if after is not None:
+                after()
+            item.future.set_result(result)
+
+WRITER = GroupWriter()
+
+# -------------------- 冷数据归档：旧对话和 source_text --------------------
+# data/archive/<kind>/<YYYY-MM>.jsonl.gz，按月分区、只追加（gzip 多成员流可直接拼接）。
+# 先写归档并 fsync，再用 op 从热存储删除；中途崩溃最多在归档里留下重复行，读取时按 id 去重。
+ARCHIVE_CACHE_PARTITIONS = 12
+
+_ARCHIVE_CACHE: "OrderedDict[Tuple[str, str], Dict[str, Dict[str, Any]]]" = OrderedDict()
+_ARCHIVE_LOCK = threading.Lock()
+
+def archive_path(kind: str, month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, kind, f"{month}.jsonl.gz")
+
+def write_archive(kind: str, recs: List[Dict[str, Any]]) -> None:
+    by_month: Dict[str, List[Dict[str, Any]]] = {}
+    for r in recs:
+        by_month.setdefault((r.get("timestamp") or "unknown")[:7], []).append(r)
+    for month, items in by_month.items():
+        path = archive_path(kind, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+                for r in items:
+                    gz.write(json.dumps(r, ensure_ascii=False).encode("utf-8") + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        with _ARCHIVE_LOCK:
+            _ARCHIVE_CACHE.pop((kind, month), None)
+
+def load_archive(kind: str, month: str) -> Dict[str, Dict[str, Any]]:
+    """按需读取一个月的归档分区（id -> 记录），最近用过的几个分区留在内存里。"""
+    key = (kind, month)
+    with _ARCHIVE_LOCK:
+        if key in _ARCHIVE_CACHE:
+            _ARCHIVE_CACHE.move_to_end(key)
+            return _ARCHIVE_CACHE[key]
+    recs: Dict[str, Dict[str, Any]] = {}
+    path = archive_path(kind, month)
+    if os.path.exists(path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                r = json.loads(line)
+                recs[r.get("id")] = r
+    with _ARCHIVE_LOCK:
+        _ARCHIVE_CACHE[key] = recs
+        while len(_ARCHIVE_CACHE) > ARCHIVE_CACHE_PARTITIONS:
+            _ARCHIVE_CACHE.popitem(last=False)
+    return recs
+
+def source_text_of(rec: Dict[str, Any]) -> Optional[str]:
+    """交易的原始消息：热存储里没有时才去读对应月份的归档。"""
+    if rec.get("source_text") is not None:
+        return rec["source_text"]
+    hit = load_archive("source_text", (rec.get("timestamp") or "unknown")[:7]).get(rec.get("id"))
+    return hit.get("source_text") if hit else None
+
+def archive_old_records(days: int = RETENTION_DAYS) -> Tuple[int, int]:
+    """把 days 天前的对话记录和交易的 source_text 移入归档，返回 (对话数, 交易数)。"""
+    before = date.today() - timedelta(days=days)
+    convs, txs = get_store().archive_candidates(before)
+    if not convs and not txs:
+        return 0, 0
+    write_archive("conversations", convs)
+    write_archive("source_text", [{"id": t.get("id"), "user_id": t.get("user_id"), "timestamp": t.get("timestamp"),
+                                   "source_text": t.get("source_text")} for t in txs])
+    # 带上 user_id / month，分片存储可以直接定位到对应的分区
+    ops = [{"op": "del", "kind": "conversations", "id": c.get("id"), "user_id": c.get("user_id"), "month": record_month(c)} for c in convs]
+    ops += [dict(unset_op(t.get("user_id"), t.get("id"), ["source_text"]), month=record_month(t)) for t in txs]
+    # 分块提交：一次积压很多时，单个大批次会长时间占住写线程，用户的写入排在它后面；
+    # 整文件重写的模式每块都要重写一遍，所以块也不宜太小
+    for i in range(0, len(ops), ARCHIVE_CHUNK):
+        WRITER.submit(None, ops[i:i + ARCHIVE_CHUNK]).result()
+    if isinstance(get_store(), JournalStore):
+        get_store().compact()   # 让快照真正变小，而不是只在日志里记删除
+    return len(convs), len(txs)
+
+def retention_loop() -> None:
+    while True:
+        try:
+            archive_old_records()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(ARCHIVE_EVERY)
+
+# -------------------- 列式分析视图（NumPy） --------------------
+ANALYTICS_INITIAL_ROWS = 64    # 每个用户列数组的初始行数，满了翻倍
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+CATEGORY_OTHER = "басқа"
+CATEGORY_STOPWORDS = {"бүгін", "кеше", "today", "yesterday", "сегодня", "вчера", "және", "and", "тг", "kzt", "теңге"}
+CATEGORY_WORD_RE = re.compile(r'[^\W\d_]{3,}')
+
+def description_category(desc: str) -> str:
+    """描述里第一个既不是收支动词、也不是日期词的词，作为粗略的类别。"""
+    for w in CATEGORY_WORD_RE.findall(desc.lower()):
+        if w in CATEGORY_STOPWORDS or any(w.startswith(k) for k in EXP_KW + INC_KW):
+            continue
+        return w
+    return CATEGORY_OTHER
+
+class UserColumns:
+    """一个用户的列：day int32（日期序数）/ amount float64 / kind int8（+1 收入，-1 其余）/ desc int32 / alive bool，前 n 行有效。"""
+
+    COLUMNS = (("day", np.int32), ("amount", np.float64), ("kind", np.int8), ("desc", np.int32), ("alive", np.bool_))
+    __slots__ = ("n", "dead", "ids", "row") + tuple(name for name, _ in COLUMNS)
+
+    def __init__(self, capacity: int = ANALYTICS_INITIAL_ROWS):
+        self.n = 0
+        self.dead = 0
+        self.ids: List[Optional[str]] = []   # 行号 -> tx_id
+        self.row: Dict[str, int] = {}        # tx_id -> 行号
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def grow(self) -> None:
+        for name, _ in self.COLUMNS:
+            col = getattr(self, name)
+            setattr(self, name, np.concatenate([col, np.zeros_like(col)]))
+
+    def compact(self) -> None:
+        keep = np.flatnonzero(self.alive[:self.n])
+        for name, _ in self.COLUMNS:
+            col = getattr(self, name)
+            new = np.zeros(max(len(keep) * 2, ANALYTICS_INITIAL_ROWS), dtype=col.dtype)
+            new[:len(keep)] = col[keep]
+            setattr(self, name, new)
+        self.ids = [self.ids[i] for i in keep]
+        self.row = {tx_id: i for i, tx_id in enumerate(self.ids)}
+        self.n = len(keep)
+        self.dead = 0
+
+class ColumnStore:
+    """
+    交易的列式视图：每个用户一组 UserColumns，描述驻留在共用的字符串表里。用户首次查询时从 TX_INDEX
+    取已加载的记录，之后由 commit_ops() 增量追加；删除只清 alive，编辑原地改列，某个用户的墓碑超过一半时只压缩该用户。
+    统计全部是掩码 + bincount 的向量化运算，只碰该用户自己的行，不再逐条访问嵌套 dict，也不反复解析时间戳。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users: Dict[int, UserColumns] = {}
+        self._owner: Dict[str, int] = {}     # tx_id -> user_id
+        self._strings: List[str] = []
+        self._string_idx: Dict[str, int] = {}
+        self._category: List[int] = []      # 描述的字符串下标 -> 类别的字符串下标
 
+    def _intern(self, text: str) -> int:
+        i = self._string_idx.get(text)
+        if i is None:
+            i = self._string_idx[text] = len(self._strings)
+            self._strings.append(text)
+            self._category.append(-1)
+            self._category[i] = self._intern(description_category(text))
+        return i
+
+    def _append(self, uc: UserColumns, rec: Dict[str, Any]) -> None:
+        o = tx_ordinal(rec)
+        tx_id = rec.get("id")
+        if o is None or tx_id in uc.row:
+            return
+        d = rec.get("data", {})
+        try:
+            amt = float(d.get("amount", 0))
+        except (TypeError, ValueError):
+            return
+        if uc.n == len(uc.day):
+            uc.grow()
+        i = uc.n
+        uc.day[i] = o
+        uc.amount[i] = amt
+        uc.kind[i] = 1 if d.get("type") == "income" else -1
+        uc.desc[i] = self._intern(str(d.get("description") or ""))
+        uc.alive[i] = True
+        uc.row[tx_id] = i
+        uc.ids.append(tx_id)
+        uc.n += 1
+        self._owner[tx_id] = rec.get("user_id")
+
+    def _ensure(self, user_id: int) -> UserColumns:
+        uc = self._users.get(user_id)
+        if uc is None:
+            # 直接用 TX_INDEX 已加载的记录，用户的交易只从存储读一次
+            recs = TX_INDEX.records(user_id)
+            uc = self._users[user_id] = UserColumns(max(ANALYTICS_INITIAL_ROWS, len(recs) * 2))
+            for rec in recs:
+                self._append(uc, rec)
+        return uc
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            touched = set()
+            for op in ops:
+                if op.get("kind") != "transactions":
+                    continue
+                if op["op"] == "add":
+                    uc = self._users.get(op["rec"].get("user_id"))
+                    if uc is not None:
+                        self._append(uc, op["rec"])
+                    continue
+                uid = self._owner.get(op["id"])
+                uc = self._users.get(uid)
+                i = uc.row.get(op["id"]) if uc is not None else None
+                if i is None:
+                    continue
+                if op["op"] == "del":
+                    uc.alive[i] = False
+                    del uc.row[op["id"]]
+                    del self._owner[op["id"]]
+                    uc.ids[i] = None
+                    uc.dead += 1
+                    touched.add(uid)
+                elif op["op"] == "edit":
+                    f = op["data"]
+                    if "amount" in f:
+                        try:
+                            uc.amount[i] = float(f["amount"])
+                        except (TypeError, ValueError):
+                            pass
+                    if "type" in f:
+                        uc.kind[i] = 1 if f["type"] == "income" else -1
+                    if "description" in f:
+                        uc.desc[i] = self._intern(str(f["description"] or ""))
+                    if "date" in f:
+                        o = tx_ordinal({"data": {"date": f["date"]}})
+                        if o is not None:
+                            uc.day[i] = o
+            for uid in touched:
+                uc = self._users[uid]
+                if uc.dead > ANALYTICS_INITIAL_ROWS and uc.dead * 2 > uc.n:
+                    uc.compact()
+
+    def _select(self, user_id: int, lo: int, hi: int) -> Tuple[UserColumns, np.ndarray]:
+        """该用户的列，以及其中日期序数在 [lo, hi] 内、仍然有效的行号。"""
+        uc = self._ensure(user_id)
+        n = uc.n
+        day = uc.day[:n]
+        return uc, np.flatnonzero(uc.alive[:n] & (day >= lo) & (day <= hi))
+
+    def period_totals(self, user_id: int, start_date: date, end_date: date, period: str = "week") -> List[Tuple[date, float, float]]:
+        """按周（周一开始）或按月分组的 (期初日期, 收入, 支出)。"""
+        with self._lock:
+            uc, idx = self._select(user_id, start_date.toordinal(), end_date.toordinal())
+            day = uc.day[idx].astype(np.int64)
+            amount, kind = uc.amount[idx], uc.kind[idx]
+        if not idx.size:
+            return []
+        if period == "week":
+            keys = day - (day - 1) % 7   # 序数 1（0001-01-01）是周一
+        else:
+            months = (day - EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]")
+            keys = months.astype("datetime64[D]").astype(np.int64) + EPOCH_ORDINAL
+        uniq, inv = np.unique(keys, return_inverse=True)
+        inc = np.bincount(inv, weights=np.where(kind == 1, amount, 0.0), minlength=len(uniq))
+        exp = np.bincount(inv, weights=np.where(kind == 1, 0.0, amount), minlength=len(uniq))
+        return [(date.fromordinal(int(k)), float(a), float(b)) for k, a, b in zip(uniq, inc, exp)]
+
+    def top_expenses(self, user_id: int, start_date: date, end_date: date, n: int = 5) -> List[Tuple[date, float, str]]:
+        with self._lock:
+            uc, idx = self._select(user_id, start_date.toordinal(), end_date.toordinal())
+            idx = idx[uc.kind[idx] != 1]
+            if idx.size > n:
+                idx = idx[np.argpartition(-uc.amount[idx], n - 1)[:n]]
+            idx = idx[np.argsort(-uc.amount[idx], kind="stable")]
+            return [(date.fromordinal(int(uc.day[i])), float(uc.amount[i]), self._strings[uc.desc[i]]) for i in idx]
+
+    def moving_average(self, user_id: int, start_date: date, end_date: date, window: int = 7) -> np.ndarray:
+        """[start_date, end_date] 每天的 window 日滑动平均支出（窗口向前取满）。"""
+        lo, hi = start_date.toordinal() - window + 1, end_date.toordinal()
+        with self._lock:
+            uc, idx = self._select(user_id, lo, hi)
+            idx = idx[uc.kind[idx] != 1]
+            daily = np.bincount(uc.day[idx].astype(np.int64) - lo, weights=uc.amount[idx], minlength=hi - lo + 1)
+        csum = np.concatenate(([0.0], np.cumsum(daily)))
+        return (csum[window:] - csum[:-window]) / window
+
+    def category_totals(self, user_id: int, start_date: date, end_date: date, n: int = 10) -> List[Tuple[str, float]]:
+        with self._lock:
+            uc, idx = self._select(user_id, start_date.toordinal(), end_date.toordinal())
+            idx = idx[uc.kind[idx] != 1]
+            # 只查该用户出现过的描述，共用字符串表再大也不碰
+            descs, inv = np.unique(uc.desc[idx], return_inverse=True)
+            cats = np.fromiter((self._category[d] for d in descs), dtype=np.int64, count=len(descs))[inv]
+            keys, inv = np.unique(cats, return_inverse=True)
+            sums = np.bincount(inv, weights=uc.amount[idx], minlength=len(keys))
+            order = np.argsort(-sums, kind="stable")[:n]
+            return [(self._strings[keys[c]], float(sums[c])) for c in order if sums[c] > 0]
+
+ANALYTICS = ColumnStore()
+
+
+# 千分位只认空格（逗号/句号是子句分隔符），小数部分 1-2 位，可带 k/к 后缀
+_NUMBER_PATTERN = r'(?P<int>\d{1,3}(?:[ \u00A0]\d{3})+(?!\d)|\d+)(?:[.,](?P<frac>\d{1,2})(?!\d))?(?:[ \u00A0]?(?P<k>[kкKК])(?!\w))?'
+NUMBER_RE = re.compile(_NUMBER_PATTERN)
+_NUMBER_SPACES = str.maketrans("", "", " \u00A0")
+
+def number_value(m: "re.Match") -> float:
+    s = m.group("int")
+    if not s.isdigit():
+        s = s.translate(_NUMBER_SPACES)
+    if m.group("frac"):
+        s = s + "." + m.group("frac")
+    return float(s) * (1000 if m.group("k") else 1)
+
+def normalize_number_token(tok: str) -> Optional[float]:
+    m = NUMBER_RE.fullmatch(tok.strip()) if tok else None
+    return number_value(m) if m else None
+
+def find_numbers_with_positions(text: str) -> List[Tuple[float,int,int,str]]:
+    return [(number_value(m), m.start(), m.end(), m.group(0)) for m in NUMBER_RE.finditer(text)]
 
 EXP_KW = ["жұмс","жұмса","шық","төл","төлед","spent","paid","pay","expense","потрат","платил","花了","支付","трат","кетті","шықты","шығыс"]
 INC_KW = ["табу","табы","табып","алды","кірі","кіріс","пайда","получ","received","got","found","得","找到","нашел","таптым","кіру","кіріс"]
 
-def nearest_keyword_type(text:str, pos:int) -> Optional[str]:
+class KeywordAutomaton:
+    """Aho-Corasick 多模式匹配：导入时构建一次，对小写文本单次扫描找出全部关键词及位置。"""
+
+    def __init__(self, patterns: List[Tuple[str, str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, str]]] = [[]]   # (关键词长度, 类型)
+        for word, label in patterns:
+            st = 0
+            for ch in word.lower():
+                nxt = self._goto[st].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({}); self._fail.append(0); self._out.append([])
+                    self._goto[st][ch] = nxt
+                st = nxt
+            if (len(word), label) not in self._out[st]:
+                self._out[st].append((len(word), label))
+        queue = deque(self._goto[0].values())
+        while queue:
+            st = queue.popleft()
+            for ch, nxt in self._goto[st].items():
+                queue.append(nxt)
+                f = self._fail[st]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                if st:
+                    self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, low: str) -> List[Tuple[int, int, str]]:
+        goto, fail, out = self._goto, self._fail, self._out
+        hits = []
+        st = 0
+        for i, ch in enumerate(low):
+            while st and ch not in goto[st]:
+                st = fail[st]
+            st = goto[st].get(ch, 0)
+            for n, label in out[st]:
+                hits.append((i - n + 1, i + 1, label))
+        hits.sort()
+        return hits
+
+KW_AUTOMATON = KeywordAutomaton([(w, "income") for w in INC_KW] + [(w, "expense") for w in EXP_KW])
+
+class KeywordHits:
+    """一条消息里所有关键词命中（按起点排序），供逐个数字查询窗口内的类型。"""
+
+    def __init__(self, hits: List[Tuple[int, int, str]]):
+        self.hits = hits
+        self.starts = [h[0] for h in hits]
+        self.labels = {h[2] for h in hits}
+
+    def labels_within(self, start: int, end: int) -> set:
+        found = set()
+        for i in range(bisect.bisect_left(self.starts, start), bisect.bisect_left(self.starts, end)):
+            if self.hits[i][1] <= end:
+                found.add(self.hits[i][2])
+        return found
+
+def scan_keywords(text: str) -> KeywordHits:
+    return KeywordHits(KW_AUTOMATON.find(text.lower()))
+
+def keyword_type(text: str) -> Optional[str]:
+    labels = scan_keywords(text).labels
+    if "income" in labels:
+        return "income"
+    if "expense" in labels:
+        return "expense"
+    return None
+
+def nearest_keyword_type(text:str, pos:int, hits: Optional[KeywordHits] = None) -> Optional[str]:
+    if hits is None:
+        hits = scan_keywords(text)
     window = 40
     start = max(0, pos - window)
     end = min(len(text), pos + window)
-    seg = text[start:end].lower()
-    for w in INC_KW:
-        if w in seg:
+    # 窗口内优先，其次整段文本；收入关键词优先于支出
+    for labels in (hits.labels_within(start, end), hits.labels):
+        if "income" in labels:
             return "income"
-    for w in EXP_KW:
-        if w in seg:
-            return "expense"
-    # whole text fallback
-    low = text.lower()
-    for w in INC_KW:
-        if w in low:
-            return "income"
-    for w in EXP_KW:
-        if w in low:
+        if "expense" in labels:
             return "expense"
     return None
 
+# -------------------- 单遍词法分析 --------------------
+# 一个正则按顺序产出子句分隔符与数字 token（绝对位置 + 已归一化的数值），
+# 关键词命中由 KW_AUTOMATON 一次扫描给出；消息多长都只扫一遍、不切子串。
+TOKEN_RE = re.compile(r'(?P<sep>[.,;!?\n]|\b(?:және|и|and|мен|та|和|و)\b)|' + _NUMBER_PATTERN, flags=re.IGNORECASE)
 
-CLAUSE_SPLIT_RE = re.compile(r'[.,;!?\n]|(?:\b(?:және|и|and|мен|та|和|و)\b)', flags=re.IGNORECASE)
-def split_clauses(text:str) -> List[Tuple[str,int]]:
-    clauses=[]
-    idx = 0
-    for part in CLAUSE_SPLIT_RE.split(text):
-        if not part:
-            idx += 1
-            continue
-        start = text.find(part, idx)
-        if start == -1: start = idx
-        clauses.append((part.strip(), start))
-        idx = start + len(part)
-    if not clauses:
-        clauses=[(text,0)]
-    return clauses
+class Lexed(NamedTuple):
+    clauses: List[Tuple[int, int]]                    # [start, end)
+    numbers: List[Tuple[float, int, int, str, int]]   # (value, start, end, raw, clause_no)
+    hits: KeywordHits
+
+def lex_message(text: str) -> Lexed:
+    clauses: List[Tuple[int, int]] = []
+    numbers: List[Tuple[float, int, int, str, int]] = []
+    cstart = 0
+    for m in TOKEN_RE.finditer(text):
+        if m.group("sep") is not None:
+            if m.start() > cstart:
+                clauses.append((cstart, m.start()))
+            cstart = m.end()
+        else:
+            numbers.append((number_value(m), m.start(), m.end(), m.group(0), len(clauses)))
+    if cstart < len(text):
+        clauses.append((cstart, len(text)))
+    return Lexed(clauses, numbers, scan_keywords(text))
 
 def parse_message_to_transactions(text: str) -> Tuple[List[Dict[str,Any]], List[Dict[str,Any]]]:
     """
@@ -152,108 +1700,298 @@ def parse_message_to_transactions(text: str) -> Tuple[List[Dict[str,Any]], List[
     """
     txs=[]
     unknowns=[]
-    clauses = split_clauses(text)
-    for clause, base_idx in clauses:
-        nums = find_numbers_with_positions(clause)
-        if not nums:
-            continue
-        for val, s, e, raw in nums:
-            abs_pos = base_idx + s
-            ttype = nearest_keyword_type(text, abs_pos)
-            if ttype is None:
-                # clause内查找关键词更精确
-                candidate_types=[]
-                low_clause = clause.lower()
-                for w in INC_KW:
-                    p = low_clause.find(w)
-                    if p!=-1:
-                        candidate_types.append(("income", abs(p - s)))
-                for w in EXP_KW:
-                    p = low_clause.find(w)
-                    if p!=-1:
-                        candidate_types.append(("expense", abs(p - s)))
-                if candidate_types:
-                    candidate_types.sort(key=lambda x: x[1])
-                    ttype = candidate_types[0][0]
-            if ttype is None:
-                unknowns.append({"amount": val, "context": clause.strip(), "pos": abs_pos})
-            else:
-                txs.append({
-                    "type": ttype,
-                    "amount": float(val),
-                    "currency": "KZT",
-                    "date": date.today().isoformat(),
-                    "description": clause.strip()[:240]
-                })
+    lx = lex_message(text)
+    today = date.today().isoformat()
+    contexts: Dict[int, str] = {}
+    for val, abs_pos, _end, _raw, ci in lx.numbers:
+        clause = contexts.get(ci)
+        if clause is None:
+            cs, ce = lx.clauses[ci]
+            clause = contexts[ci] = text[cs:ce].strip()
+        ttype = nearest_keyword_type(text, abs_pos, lx.hits)
+        if ttype is None:
+            unknowns.append({"amount": val, "context": clause, "pos": abs_pos})
+        else:
+            txs.append({
+                "type": ttype,
+                "amount": float(val),
+                "currency": "KZT",
+                "date": today,
+                "description": clause[:240]
+            })
     return txs, unknowns
 
 # -------------------- Ollama 备援（仅在本地解析失败时调用） --------------------
-def call_ollama_for_transaction(user_text: str, model: str = MODEL_NAME) -> Dict[str, Any]:
+# 备援在有界线程池里执行并复用连接池；处理器不再阻塞在模型上，池满时直接走数字回退。
+LLM_WORKERS = 4
+LLM_MAX_PENDING = 16   # 执行中 + 排队中的请求上限
+LLM_TIMEOUT = 6
+
+HTTP = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=LLM_WORKERS)
+HTTP.mount("http://", _adapter)
+HTTP.mount("https://", _adapter)
+
+LLM_POOL = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+_LLM_SLOTS = threading.BoundedSemaphore(LLM_MAX_PENDING)
+
+def submit_llm_parse(user_text: str, endpoint: Optional[str] = None) -> Optional[Future]:
+    """提交到备援线程池；池已满时返回 None，由调用方降级。"""
+    if not _LLM_SLOTS.acquire(blocking=False):
+        return None
+    try:
+        fut = LLM_POOL.submit(cached_ollama_parse, user_text, MODEL_NAME, endpoint)
+    except RuntimeError:
+        _LLM_SLOTS.release()
+        return None
+    fut.add_done_callback(lambda _f: _LLM_SLOTS.release())
+    return fut
+
+def call_ollama_for_transaction(user_text: str, model: str = MODEL_NAME, endpoint: Optional[str] = None) -> Dict[str, Any]:
+    """
+    流式调用 /api/generate：把逐块返回的文本喂给 JSONStreamExtractor，
+    第一个对象/数组一配平就关闭连接，不等模型把整段回答生成完。
+    """
     system_prompt = (
         "You are a financial assistant. Respond ONLY with JSON array or JSON object.\n"
         "Fields: type (income|expense), amount (number), currency (string), date (YYYY-MM-DD), description (short)."
     )
-    payload = {"model": model, "messages":[{"role":"system","content":system_prompt},{"role":"user","content":user_text}], "max_tokens":256, "temperature":0.0}
+    payload = {"model": model, "system": system_prompt, "prompt": user_text, "stream": True,
+               "options": {"temperature": 0.0, "num_predict": 256}}
+    deadline = time.monotonic() + LLM_TIMEOUT
+    parts: List[str] = []
     try:
-        resp = requests.post(OLLAMA_API_ENDPOINT, json=payload, timeout=6)
-        resp.raise_for_status()
-        j = resp.json()
-        merged = json.dumps(j, ensure_ascii=False)
-        js = extract_first_json_object(merged)
-        if js:
-            return {"json": json.loads(js), "raw": merged}
-        return {"raw": merged}
+        with HTTP.post(endpoint or OLLAMA_API_ENDPOINT, json=payload, timeout=LLM_TIMEOUT, stream=True) as resp:
+            resp.raise_for_status()
+            extractor = JSONStreamExtractor()
+            # chunk_size=1：默认 512 字节要攒满才交出一行，JSON 早已配平还得等后面的 token
+            for line in resp.iter_lines(chunk_size=1):
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                piece = chunk.get("response", "")
+                parts.append(piece)
+                js = extractor.feed(piece)
+                if js:
+                    return {"json": json.loads(js), "raw": "".join(parts)}
+                if chunk.get("done"):
+                    break
+                if time.monotonic() > deadline:
+                    return {"error": "timeout", "raw": "".join(parts)}
+        return {"raw": "".join(parts)}
     except Exception as e:
         return {"error": str(e)}
 
+class JSONStreamExtractor:
+    """增量提取第一个完整的 JSON 对象或数组：按块 feed，括号配平时返回该片段，否则返回 None。"""
+
+    def __init__(self):
+        self._buf: List[str] = []
+        self._started = False
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    def feed(self, chunk: str) -> Optional[str]:
+        for ch in chunk:
+            if not self._started:
+                if ch == "{" or ch == "[":
+                    self._started = True
+                    self._depth = 1
+                    self._buf.append(ch)
+                continue
+            self._buf.append(ch)
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{" or ch == "[":
+                self._depth += 1
+            elif ch == "}" or ch == "]":
+                self._depth -= 1
+                if self._depth == 0:
+                    return "".join(self._buf)
+        return None
+
 def extract_first_json_object(s: str) -> Optional[str]:
     # 尝试找第一个 JSON 对象或数组
-    start = s.find("{")
-    if start == -1:
-        start = s.find("[")
-        if start == -1:
-            return None
-        depth = 0; in_str = False; esc = False
-        for i in range(start, len(s)):
-            ch = s[i]
-            if ch == '"' and not esc:
-                in_str = not in_str
-            if in_str and ch == "\\" and not esc:
-                esc = True; continue
-            if not in_str:
-                if ch == '[':
-                    depth += 1
-                elif ch == ']':
-                    depth -= 1
-                    if depth == 0:
-                        return s[start:i+1]
-            if esc:
-                esc = False
+    return JSONStreamExtractor().feed(s)
+
+# -------------------- 备援结果缓存 --------------------
+# 用户反复发同样的说法（"такси 2000"、"кофе 1500"）。按消息模板缓存模型的结构化回答：
+# 金额、日期换成占位符，大小写与空白折叠；命中时把这次的真实数字代回去。
+# 消息里没写日期时模型给的 date（“今天”“昨天”）按相对今天的天数存，命中时按当天重新算。
+LLM_CACHE_FILE = os.path.join(DATA_DIR, "llm_cache.json")
+LLM_CACHE_MAX = 5000
+LLM_CACHE_TTL = 30 * 24 * 3600   # 秒
+
+TEMPLATE_RE = re.compile(r'(?P<date>\d{4}-\d{2}-\d{2}|\d{1,2}\.\d{1,2}\.\d{4})|' + _NUMBER_PATTERN)
+PLACEHOLDER_RE = re.compile(r'<([nd])(\d+)>')
+
+def iso_date_token(tok: str) -> str:
+    if "-" in tok:
+        return tok
+    d, mth, y = tok.split(".")
+    return f"{y}-{int(mth):02d}-{int(d):02d}"
+
+def message_template(text: str) -> Tuple[str, List[Tuple[float, str]], List[str]]:
+    """返回 (模板, [(数值, 原文)], [ISO 日期])。"""
+    low = " ".join(text.lower().split())
+    dates: List[str] = []
+    nums: List[Tuple[float, str]] = []
+    def _token(m):
+        if m.group("date"):
+            dates.append(iso_date_token(m.group("date")))
+            return f"<d{len(dates) - 1}>"
+        nums.append((number_value(m), m.group(0)))
+        return f"<n{len(nums) - 1}>"
+    return TEMPLATE_RE.sub(_token, low), nums, dates
+
+def relative_date(value: Any) -> Optional[Dict[str, int]]:
+    try:
+        return {"$today": (date.fromisoformat(str(value)) - date.today()).days}
+    except ValueError:
         return None
-    depth = 0; in_str = False; esc = False
-    for i in range(start, len(s)):
-        ch = s[i]
-        if ch == '"' and not esc:
-            in_str = not in_str
-        if in_str and ch == "\\" and not esc:
-            esc = True; continue
-        if not in_str:
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    return s[start:i+1]
-        if esc:
-            esc = False
-    return None
+
+def to_template(obj: Any, nums: List[Tuple[float, str]], dates: List[str]) -> Any:
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            tv = to_template(v, nums, dates)
+            if k == "date" and isinstance(tv, str) and "<d" not in tv:
+                # 日期不是从消息里来的：不能原样缓存，否则明天命中还是今天的日期；解析不了就干脆不存
+                tv = relative_date(v)
+                if tv is None:
+                    continue
+            out[k] = tv
+        return out
+    if isinstance(obj, list):
+        return [to_template(v, nums, dates) for v in obj]
+    if isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        for i, (val, _raw) in enumerate(nums):
+            if float(obj) == val:
+                return {"$n": i}
+        return obj
+    if isinstance(obj, str):
+        values = [v for v, _raw in nums]
+        def _token(m):
+            if m.group("date"):
+                iso = iso_date_token(m.group("date"))
+                return f"<d{dates.index(iso)}>" if iso in dates else m.group(0)
+            v = number_value(m)
+            return f"<n{values.index(v)}>" if v in values else m.group(0)
+        return TEMPLATE_RE.sub(_token, obj)
+    return obj
+
+def fill_template(obj: Any, nums: List[Tuple[float, str]], dates: List[str]) -> Any:
+    if isinstance(obj, dict):
+        if set(obj) == {"$n"}:
+            i = obj["$n"]
+            return nums[i][0] if i < len(nums) else None
+        if set(obj) == {"$today"}:
+            return (date.today() + timedelta(days=obj["$today"])).isoformat()
+        return {k: fill_template(v, nums, dates) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [fill_template(v, nums, dates) for v in obj]
+    if isinstance(obj, str):
+        def _sub(m):
+            i = int(m.group(2))
+            if m.group(1) == "n":
+                return nums[i][1] if i < len(nums) else m.group(0)
+            return dates[i] if i < len(dates) else m.group(0)
+        return PLACEHOLDER_RE.sub(_sub, obj)
+    return obj
+
+class LLMCache:
+    """LRU + TTL 的模板缓存，每次写入后原子地落盘，重启（部署）后仍然是热的。"""
+
+    def __init__(self, path: str, max_items: int = LLM_CACHE_MAX, ttl: float = LLM_CACHE_TTL):
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._loaded = False
+
+    def _ensure(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f).get("items", [])
+        except Exception:
+            return
+        now = time.time()
+        for key, ts, payload in items[-self.max_items:]:
+            if now - ts < self.ttl:
+                self._items[key] = (ts, payload)
+
+    def _save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"items": [[k, ts, p] for k, (ts, p) in self._items.items()]}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            self._ensure()
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if time.time() - item[0] >= self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key: str, payload: Any) -> None:
+        with self._lock:
+            self._ensure()
+            self._items[key] = (time.time(), payload)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+            try:
+                self._save()
+            except OSError:
+                traceback.print_exc()
+
+LLM_CACHE = LLMCache(LLM_CACHE_FILE)
+
+LLM_CACHE_VERSION = "2"   # 模板格式变了就加一，旧文件里的条目自然不再命中
+
+def llm_cache_key(tpl: str, model: str) -> str:
+    return LLM_CACHE_VERSION + "\x00" + model + "\x00" + tpl
+
+def llm_cache_lookup(user_text: str, model: str = MODEL_NAME) -> Optional[Any]:
+    tpl, nums, dates = message_template(user_text)
+    hit = LLM_CACHE.get(llm_cache_key(tpl, model))
+    return fill_template(hit, nums, dates) if hit is not None else None
+
+def cached_ollama_parse(user_text: str, model: str = MODEL_NAME, endpoint: Optional[str] = None) -> Dict[str, Any]:
+    tpl, nums, dates = message_template(user_text)
+    key = llm_cache_key(tpl, model)
+    hit = LLM_CACHE.get(key)
+    if hit is not None:
+        return {"json": fill_template(hit, nums, dates), "cached": True}
+    resp = call_ollama_for_transaction(user_text, model, endpoint)
+    if "json" in resp:
+        LLM_CACHE.put(key, to_template(resp["json"], nums, dates))
+    return resp
 
 # -------------------- 存储、检索、导出辅助 --------------------
-def save_transactions(user_id:int, user_text:str, txs:List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-    data = load_data()
+def save_transactions(user_id:int, user_text:str, txs:List[Dict[str,Any]], fingerprints:Optional[List[str]]=None) -> List[Dict[str,Any]]:
     saved=[]
     ts = datetime.now(timezone.utc).isoformat()
-    for t in txs:
+    for i, t in enumerate(txs):
         rec = {
             "id": str(uuid.uuid4()),
             "user_id": user_id,
@@ -261,90 +1999,380 @@ def save_transactions(user_id:int, user_text:str, txs:List[Dict[str,Any]]) -> Li
             "data": t,
             "source_text": user_text
         }
-        data["transactions"].append(rec)
+        if fingerprints:
+            rec["fp"] = fingerprints[i]
         saved.append(rec)
-    data["conversations"].append({"id":str(uuid.uuid4()), "user_id":user_id, "timestamp":ts, "text":user_text, "tx_ids":[r["id"] for r in saved]})
-    save_data(data)
-    return saved
+    ops = [add_op("transactions", r) for r in saved]
+    ops.append(add_op("conversations", {"id":str(uuid.uuid4()), "user_id":user_id, "timestamp":ts, "text":user_text, "tx_ids":[r["id"] for r in saved]}))
+    return WRITER.append(user_id, ops, saved, undoable=True).result()
+
+def summary_for_range(user_id:int, start_date:date, end_date:date) -> Tuple[float,float]:
+    """区间收入/支出合计，由日/月汇总拼出，与区间内的交易笔数无关。"""
+    return TX_INDEX.totals(user_id, start_date, end_date)
 
 def totals_for_period(user_id:int, start_date:date, end_date:date) -> Tuple[float,float]:
-    data = load_data()
-    inc=0.0; exp=0.0
-    for t in data.get("transactions",[]):
-        if t.get("user_id")!=user_id: continue
-        try:
-            dt = datetime.fromisoformat(t.get("timestamp")).date()
-            if not (start_date <= dt <= end_date): continue
-            d = t.get("data",{})
-            amt = float(d.get("amount",0))
-            if d.get("type")=="income": inc+=amt
-            else: exp+=amt
-        except:
-            continue
-    return inc, exp
+    return summary_for_range(user_id, start_date, end_date)
 
 def list_transactions_for_date(user_id:int, target:date) -> List[Dict[str,Any]]:
-    data = load_data()
-    out=[]
-    for t in data.get("transactions",[]):
-        if t.get("user_id")!=user_id: continue
-        try:
-            dt = datetime.fromisoformat(t.get("timestamp")).date()
-            if dt==target:
-                out.append(t)
-        except:
-            continue
-    return out
+    return TX_INDEX.range(user_id, target, target)
+
+EXPORT_COLUMNS = ["id", "type", "amount", "currency", "date", "description"]
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024  # 超过此大小才溢出到系统临时目录
+EXPORT_CACHE_MAX = 1000
+
+class ExportCache:
+    """记住已经发给 Telegram 的文件 file_id：key -> (数据版本, file_id)，版本变了就视为未命中。"""
+
+    def __init__(self, max_items: int = EXPORT_CACHE_MAX):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Any, Tuple[int, str]]" = OrderedDict()
+
+    def get(self, key, version: int) -> Optional[str]:
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None or hit[0] != version:
+                return None
+            self._items.move_to_end(key)
+            return hit[1]
 
-def export_transactions_to_csv(trans:List[Dict[str,Any]], filename:str) -> str:
-    rows=[]
+    def put(self, key, version: int, file_id: str) -> None:
+        with self._lock:
+            self._items[key] = (version, file_id)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+EXPORT_CACHE = ExportCache()
+
+def iter_export_rows(trans:List[Dict[str,Any]]):
+    # 逐条产出导出行，不构造 DataFrame
     for t in trans:
         d=t.get("data",{})
-        rows.append({"id":t.get("id"), "type":d.get("type"), "amount":d.get("amount"), "currency":d.get("currency"), "date":d.get("date"), "description":d.get("description")})
-    df = pd.DataFrame(rows)
-    path = os.path.join(DATA_DIR, filename)
-    df.to_csv(path, index=False, encoding="utf-8-sig")
-    return path
+        yield [t.get("id"), d.get("type"), d.get("amount"), d.get("currency"), d.get("date"), d.get("description")]
+
+def export_transactions(rows, fmt:str="csv"):
+    """把行流式写入内存缓冲（CSV 或 write-only XLSX），返回已 seek(0) 的二进制文件对象；data/ 下不留文件。"""
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+    if fmt == "xlsx":
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("transactions")
+        ws.append(EXPORT_COLUMNS)
+        for r in rows:
+            ws.append(r)
+        wb.save(buf)
+    else:
+        text = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+        w = csv.writer(text)
+        w.writerow(EXPORT_COLUMNS)
+        w.writerows(rows)
+        text.flush()
+        text.detach()  # 缓冲区归调用方关闭
+    buf.seek(0)
+    return buf
+
+def send_export(m, user_id:int, start_date:date, end_date:date, fmt:str="csv") -> None:
+    # 版本号先于读取：期间若有写入，缓存下的旧版本下次自然失效
+    key = (user_id, start_date, end_date, fmt)
+    version = DATA_VERSIONS.get(user_id)
+    file_id = EXPORT_CACHE.get(key, version)
+    if file_id:
+        # 数据没变：直接复用 Telegram 上已有的文件，不序列化也不重新上传
+        bot.send_document(m.chat.id, file_id)
+        bot.reply_to(m, KZ["export_ready"])
+        return
+    trans = TX_INDEX.range(user_id, start_date, end_date)
+    if not trans:
+        bot.reply_to(m, KZ["no_transactions"])
+        return
+    span = start_date.isoformat() if start_date == end_date else f"{start_date.isoformat()}_{end_date.isoformat()}"
+    with export_transactions(iter_export_rows(trans), fmt) as buf:
+        sent = bot.send_document(m.chat.id, buf, visible_file_name=f"export_{user_id}_{span}.{fmt}")
+    EXPORT_CACHE.put(key, version, sent.document.file_id)
+    bot.reply_to(m, KZ["export_ready"])
 
-def index_uploaded_file(user_id:int, filename:str, path:str) -> None:
-    data = load_data()
-    data["files"].append({"id":str(uuid.uuid4()), "user_id":user_id, "timestamp":datetime.now(timezone.utc).isoformat(), "filename":filename, "path":path})
-    save_data(data)
+def send_stored_file(m, f:Dict[str,Any]) -> None:
+    # 上传的文件不会再变：优先用上传时记下的 file_id，旧记录第一次发送后补记到缓存
+    file_id = f.get("file_id") or EXPORT_CACHE.get(("file", f.get("id")), 0)
+    if file_id:
+        bot.send_document(m.chat.id, file_id)
+        return
+    with open(f["path"], "rb") as fh:
+        sent = bot.send_document(m.chat.id, fh, visible_file_name=f.get("filename"))
+    EXPORT_CACHE.put(("file", f.get("id")), 0, sent.document.file_id)
+
+def index_uploaded_file(user_id:int, filename:str, path:str, file_id:Optional[str]=None, sha256:Optional[str]=None) -> None:
+    WRITER.append(user_id, [add_op("files", {"id":str(uuid.uuid4()), "user_id":user_id, "timestamp":datetime.now(timezone.utc).isoformat(), "filename":filename, "path":path, "file_id":file_id, "sha256":sha256})]).result()
 
 def find_file_by_name_or_date(user_id:int, text:str) -> Optional[Dict[str,Any]]:
-    # 尝试按文件名关键词匹配
-    data = load_data()
-    low = text.lower()
-    # 按文件名包含关键词搜索
-    for f in reversed(data.get("files", [])):  # 最近上传优先
-        if f.get("user_id")!=user_id: continue
-        if f.get("filename") and f.get("filename").lower() in low:
-            return f
-    # 按出现的显式日期 YYYY-MM-DD 搜索
-    m = re.search(r'(\d{4}-\d{2}-\d{2})', text)
-    if m:
-        dstr = m.group(1)
-        for f in reversed(data.get("files", [])):
-            if f.get("user_id")!=user_id: continue
-            try:
-                if f.get("timestamp", "").startswith(dstr):
-                    return f
-            except:
-                continue
-    # 近似名字匹配（关键词）
-    for f in reversed(data.get("files", [])):
-        if f.get("user_id")!=user_id: continue
-        fname = f.get("filename","").lower()
-        for token in low.split():
-            if token and token in fname:
-                return f
-    return None
+    # 走文件目录索引，不再逐个扫描全部文件
+    return FILE_CATALOG.find(user_id, text)
+
+# -------------------- Excel 列式导入 --------------------
+# 表头关键字（小写、包含即可）。先识别一次列，再整列转换；识别不出金额列时才逐行猜。
+AMOUNT_COLS = ("amount", "sum", "сумма", "сома", "金额", "total")
+INCOME_COLS = ("income", "кіріс", "приход", "поступлен", "credit", "收入")
+EXPENSE_COLS = ("expense", "шығыс", "расход", "списан", "debit", "支出")
+DATE_COLS = ("date", "дата", "күн", "日期")
+TYPE_COLS = ("type", "тип", "түр", "类型")
+DESC_COLS = ("description", "desc", "описание", "назначение", "детали", "сипаттама", "comment", "备注", "说明")
+
+INC_KW_RE = "|".join(re.escape(w) for w in INC_KW)
+INC_TYPE_RE = "|".join(re.escape(w) for w in INC_KW + list(INCOME_COLS) + ["доход", "+"])
+
+def detect_columns(df: pd.DataFrame) -> Dict[str, Any]:
+    cols: Dict[str, Any] = {}
+    for c in df.columns:
+        name = str(c).strip().lower()
+        for role, keys in (("type", TYPE_COLS), ("date", DATE_COLS), ("income", INCOME_COLS),
+                           ("expense", EXPENSE_COLS), ("amount", AMOUNT_COLS), ("description", DESC_COLS)):
+            if role not in cols and any(k in name for k in keys):
+                cols[role] = c
+                break
+    return cols
+
+def to_amounts(col: pd.Series) -> pd.Series:
+    """
+    文本金额整列转数字。"," 和 "." 同时出现时靠后的那个是小数点、另一个是千分位
+    （1,234.56 / 1.234,56）；只出现一种且重复多次时是千分位（1,234,567）；只有一个 "," 时按小数点。
+    """
+    if pd.api.types.is_numeric_dtype(col):
+        return col.astype("float64")
+    s = col.astype(str).str.replace(r"[\s\u00A0]", "", regex=True)
+    comma, dot = s.str.rfind(","), s.str.rfind(".")
+    comma_thousands = ((comma >= 0) & (dot > comma)) | ((dot < 0) & (s.str.count(",") > 1))
+    dot_thousands = ((dot >= 0) & (comma > dot)) | ((comma < 0) & (s.str.count(r"\.") > 1))
+    s = s.where(~comma_thousands, s.str.replace(",", "", regex=False))
+    s = s.where(~dot_thousands, s.str.replace(".", "", regex=False))
+    s = s.str.replace(",", ".", regex=False)
+    s = s.str.replace(r"[^0-9.\-]", "", regex=True)
+    return pd.to_numeric(s, errors="coerce")
+
+def unparsed_amounts(raw: pd.Series, parsed: pd.Series) -> pd.Series:
+    """单元格里有内容、却没解析出数字的行（空单元格不算）。"""
+    filled = raw.notna() & (raw.astype(str).str.strip() != "")
+    return filled & parsed.isna()
+
+def classify_text(col: pd.Series, pattern: str = INC_KW_RE) -> pd.Series:
+    """按关键词整列判断类型：命中收入关键词为 income，否则 expense。"""
+    low = col.fillna("").astype(str).str.lower()
+    return pd.Series(np.where(low.str.contains(pattern, regex=True), "income", "expense"), index=col.index)
+
+def to_iso_dates(col: pd.Series, default: str) -> pd.Series:
+    """先按 ISO，再按 日.月.年，最后逐个按日在前解析；每步都给出格式，pandas 不用猜（也就不会每块都警告）。"""
+    dates = pd.to_datetime(col, errors="coerce", format="ISO8601")
+    for fmt in ("%d.%m.%Y", "mixed"):
+        missing = dates.isna() & col.notna()
+        if not missing.any():
+            break
+        extra = {"dayfirst": True} if fmt == "mixed" else {}
+        dates = dates.where(~missing, pd.to_datetime(col.where(missing), errors="coerce", format=fmt, **extra))
+    return dates.dt.strftime("%Y-%m-%d").fillna(default)
+
+def rows_to_transactions_heuristic(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """识别不出列时的回退：逐行拼文本，取第一个数字作为金额。"""
+    out=[]
+    today = date.today().isoformat()
+    for row in df.itertuples(index=False):
+        row_text = " ".join([str(x) for x in row if pd.notna(x)])
+        nums = find_numbers_with_positions(row_text)
+        if nums:
+            typ = keyword_type(row_text) or "expense"
+            out.append({"type":typ,"amount":float(nums[0][0]),"currency":"KZT","date":today,"description":row_text[:240]})
+    return out
+
+def extract_transactions_from_frame(df: pd.DataFrame) -> Tuple[List[Dict[str, Any]], int]:
+    """返回 (交易列表, 金额列有内容但解析不出数字而被丢弃的行数)。"""
+    if df.empty:
+        return [], 0
+    cols = detect_columns(df)
+    if "amount" not in cols and "income" not in cols and "expense" not in cols:
+        return rows_to_transactions_heuristic(df), 0
+    today = date.today().isoformat()
+
+    # 描述：指定列，否则把其余文本列整列拼接
+    if "description" in cols:
+        desc = df[cols["description"]].fillna("").astype(str)
+    else:
+        used = {cols.get(r) for r in ("amount", "income", "expense", "date", "type")}
+        text_cols = [c for c in df.columns if c not in used
+                     and not pd.api.types.is_numeric_dtype(df[c]) and not pd.api.types.is_datetime64_any_dtype(df[c])]
+        desc = pd.Series("", index=df.index)
+        for c in text_cols:
+            desc = desc.str.cat(df[c].fillna("").astype(str), sep=" ")
+        desc = desc.str.strip()
+
+    if "amount" in cols:
+        amount = to_amounts(df[cols["amount"]])
+        bad = unparsed_amounts(df[cols["amount"]], amount)
+        if "type" in cols:
+            ttype = classify_text(df[cols["type"]], INC_TYPE_RE)
+        else:
+            ttype = classify_text(desc)
+            # 带符号的流水（有负数，或正数写了 "+"）：正数就是入账，不再交给关键词判断
+            plus = df[cols["amount"]].astype(str).str.lstrip().str.startswith("+")
+            ttype = ttype.where(~((amount > 0) & (plus | bool((amount < 0).any()))), "income")
+        # 负数一律视为支出
+        ttype = ttype.where(~(amount < 0), "expense")
+        amount = amount.abs()
+    else:
+        inc = to_amounts(df[cols["income"]]).abs() if "income" in cols else pd.Series(np.nan, index=df.index)
+        exp = to_amounts(df[cols["expense"]]).abs() if "expense" in cols else pd.Series(np.nan, index=df.index)
+        is_inc = inc.fillna(0) > 0
+        amount = inc.where(is_inc, exp)
+        # 收入、支出两列里有内容的都没解析出来才算丢弃
+        bad = pd.Series(False, index=df.index)
+        for role, parsed in (("income", inc), ("expense", exp)):
+            if role in cols:
+                bad |= unparsed_amounts(df[cols[role]], parsed)
+        bad &= amount.isna()
+        ttype = pd.Series(np.where(is_inc, "income", "expense"), index=df.index)
+
+    if "date" in cols:
+        dates = to_iso_dates(df[cols["date"]], today)
+    else:
+        dates = pd.Series(today, index=df.index)
+
+    out = pd.DataFrame({"type": ttype, "amount": amount, "currency": "KZT", "date": dates, "description": desc.str.slice(0, 240)})
+    out = out[out["amount"].notna() & (out["amount"] != 0)]
+    return out.to_dict("records"), int(bad.sum())
+
+# -------------------- 大文件流式读取 --------------------
+# 按固定行数分块读取，每块解析后立即入库；峰值内存只和块大小有关，与文件大小无关。
+INGEST_CHUNK_ROWS = 5000
+DOWNLOAD_CHUNK_BYTES = 1 << 16
+TABULAR_EXTS = (".xls", ".xlsx", ".csv")
+
+def telegram_file_url(file_path: str) -> str:
+    tmpl = telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+    return tmpl.format(bot.token, file_path)
+
+def download_to(url: str, dest: str) -> str:
+    """流式写盘，边写边算 SHA-256，返回十六进制摘要。"""
+    digest = hashlib.sha256()
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        with open(dest, "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+                f.write(chunk)
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def store_upload(tmp_path: str, sha256: str, file_name: str) -> str:
+    """按内容寻址存放上传文件：files/ab/abcdef....xlsx；同样的内容只保留一份。"""
+    ext = os.path.splitext(file_name)[1].lower()
+    dest = os.path.join(FILES_DIR, sha256[:2], sha256 + ext)
+    if os.path.exists(dest):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp_path, dest)
+    return dest
+
+def iter_xlsx_chunks(path: str, chunk_rows: int):
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = None
+        for row in rows:
+            if any(v is not None for v in row):
+                header = [str(v) if v is not None else f"col{i}" for i, v in enumerate(row)]
+                break
+        if header is None:
+            return
+        n = len(header)
+        buf = []
+        for row in rows:
+            # read-only 模式下行长度可能不一致，补齐/截断到表头宽度
+            buf.append(row[:n] if len(row) >= n else row + (None,) * (n - len(row)))
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header)
+    finally:
+        wb.close()
+
+def iter_csv_chunks(path: str, chunk_rows: int):
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        sample = f.read(8192)
+    try:
+        sep = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        sep = ","
+    yield from pd.read_csv(path, sep=sep, chunksize=chunk_rows, encoding="utf-8-sig", encoding_errors="replace")
+
+def iter_table_chunks(path: str, chunk_rows: int = INGEST_CHUNK_ROWS):
+    low = path.lower()
+    if low.endswith(".csv"):
+        yield from iter_csv_chunks(path, chunk_rows)
+    elif low.endswith(".xlsx"):
+        yield from iter_xlsx_chunks(path, chunk_rows)
+    else:
+        # .xls 没有流式读取器，只能整表读入后分块处理
+        df = pd.read_excel(path)
+        for i in range(0, len(df), chunk_rows):
+            yield df.iloc[i:i + chunk_rows]
+
+def row_key(user_id: int, t: Dict[str, Any]) -> str:
+    desc = " ".join(str(t.get("description") or "").lower().split())
+    return f"{user_id}|{t.get('date')}|{float(t.get('amount') or 0):.2f}|{desc}"
+
+class IngestResult(NamedTuple):
+    count: int                   # 新保存的交易数
+    skipped: int                 # 按指纹跳过的重复行数
+    dropped: int                 # 金额解析失败被丢弃的行数
+    error: Optional[str] = None  # 中途读失败时的错误；此前的块已经提交
+
+def ingest_table_file(user_id: int, file_name: str, path: str) -> IngestResult:
+    """
+    逐块解析并保存。每块单独提交，所以中途某块出错时前面的块已经落盘：
+    一条都还没保存时直接抛出异常；已经保存过的则返回带 error 的部分结果，由调用方如实告诉用户。
+    每行的指纹 = (用户, 日期, 金额, 规范化描述, 该组合在本文件中的第几次出现)，
+    重复上传或期间重叠的对账单里已导入过的行按指纹查索引跳过；同一天两笔相同消费仍各算一笔。
+    """
+    count = skipped = dropped = 0
+    seen: Dict[str, int] = {}
+    try:
+        for chunk in iter_table_chunks(path):
+            fresh, fps = [], []
+            txs, bad = extract_transactions_from_frame(chunk)
+            dropped += bad
+            for t in txs:
+                key = row_key(user_id, t)
+                occurrence = seen.get(key, 0)
+                seen[key] = occurrence + 1
+                fp = hashlib.sha1(f"{key}|{occurrence}".encode("utf-8")).hexdigest()
+                if TX_INDEX.has_fingerprint(user_id, fp):
+                    skipped += 1
+                    continue
+                fresh.append(t)
+                fps.append(fp)
+            if fresh:
+                count += len(save_transactions(user_id, f"excel:{file_name}", fresh, fps))
+    except Exception as e:
+        if not count:
+            raise
+        traceback.print_exc()
+        return IngestResult(count, skipped, dropped, str(e) or type(e).__name__)
+    return IngestResult(count, skipped, dropped)
 
 # -------------------- Telegram 交互 --------------------
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
 
+# 撤销 / 重做只认整条消息：这些词也常出现在普通记账句子里（“повторил платеж 3000”“кері қайтарды 5000”）
+UNDO_COMMANDS = {"/undo", "undo", "отмени", "отмена", "отменить", "болдырма", "болдырмау", "кері қайтар"}
+REDO_COMMANDS = {"/redo", "redo", "повтори", "повторить", "қайтала", "қайталау"}
+
 def detect_intent(text:str) -> Optional[str]:
     low = text.lower()
+    whole = low.strip().rstrip("!.").strip().split("@", 1)[0]   # /undo@botname 也算
+    if whole in REDO_COMMANDS:
+        return "redo"
+    if whole in UNDO_COMMANDS:
+        return "undo"
     if any(w in low for w in ["удали последнее","удали последний","жой","удалить последний","delete last"]):
         return "delete_last"
     if any(w in low for w in ["экспорт","export","csv","excel","файл жібер","берші excel","отправь excel"]):
@@ -361,6 +2389,79 @@ def detect_intent(text:str) -> Optional[str]:
 def cmd_start(m):
     bot.reply_to(m, KZ["greeting"])
 
+def report_lines(rows: List[Tuple[date, float, float]], fmt_label) -> str:
+    return "\n".join(KZ["report_line"].format(label=fmt_label(d), inc=inc, exp=exp, net=inc-exp) for d, inc, exp in rows)
+
+@bot.message_handler(commands=["week"])
+def cmd_week(m):
+    # 最近 8 周的周汇总 + 今天的 7 日滑动平均支出
+    try:
+        today = date.today()
+        start = today - timedelta(days=today.weekday() + 7 * 7)
+        rows = ANALYTICS.period_totals(m.from_user.id, start, today, "week")
+        if not rows:
+            bot.reply_to(m, KZ["no_transactions"])
+            return
+        ma = ANALYTICS.moving_average(m.from_user.id, today, today)[-1]
+        bot.reply_to(m, KZ["weekly_report"].format(n=len(rows), lines=report_lines(rows, lambda d: d.isoformat()), ma=ma))
+    except Exception as e:
+        traceback.print_exc()
+        bot.reply_to(m, KZ["error"].format(err=str(e)))
+
+@bot.message_handler(commands=["month"])
+def cmd_month(m):
+    # 最近 6 个月的月汇总 + 本月最大的 5 笔支出
+    try:
+        today = date.today()
+        first = today.replace(day=1)
+        start = date(first.year - (first.month <= 5), (first.month - 6) % 12 + 1, 1)
+        rows = ANALYTICS.period_totals(m.from_user.id, start, today, "month")
+        if not rows:
+            bot.reply_to(m, KZ["no_transactions"])
+            return
+        top = ANALYTICS.top_expenses(m.from_user.id, first, today)
+        top_lines = "\n".join(f"{d.isoformat()} — {amt:.2f} KZT {desc[:40]}" for d, amt, desc in top) or "—"
+        bot.reply_to(m, KZ["monthly_report"].format(n=len(rows), lines=report_lines(rows, lambda d: d.strftime("%Y-%m")), top=top_lines))
+    except Exception as e:
+        traceback.print_exc()
+        bot.reply_to(m, KZ["error"].format(err=str(e)))
+
+@bot.message_handler(commands=["categories"])
+def cmd_categories(m):
+    # /categories [YYYY-MM-DD YYYY-MM-DD]，默认本月
+    try:
+        dates = re.findall(r'(\d{4}-\d{2}-\d{2})', m.text or "")
+        if len(dates) >= 2:
+            start, end = sorted(datetime.fromisoformat(d).date() for d in dates[:2])
+        else:
+            end = date.today()
+            start = end.replace(day=1)
+        cats = ANALYTICS.category_totals(m.from_user.id, start, end)
+        if not cats:
+            bot.reply_to(m, KZ["no_transactions"])
+            return
+        lines = "\n".join(f"{name}: {amt:.2f} KZT" for name, amt in cats)
+        bot.reply_to(m, KZ["category_report"].format(start=start, end=end, lines=lines))
+    except Exception as e:
+        traceback.print_exc()
+        bot.reply_to(m, KZ["error"].format(err=str(e)))
+
+@bot.message_handler(commands=["source"])
+def cmd_source(m):
+    # /source [YYYY-MM-DD]：某天交易的原始消息，已归档的按月份从冷归档按需读回；默认今天
+    try:
+        found = re.search(r'(\d{4}-\d{2}-\d{2})', m.text or "")
+        target = datetime.fromisoformat(found.group(1)).date() if found else date.today()
+        trans = list_transactions_for_date(m.from_user.id, target)
+        if not trans:
+            bot.reply_to(m, KZ["no_transactions"])
+            return
+        lines = "\n".join(f"{t['data'].get('type')} {float(t['data'].get('amount') or 0):.2f} KZT — {source_text_of(t) or '—'}" for t in trans)
+        bot.reply_to(m, KZ["source_report"].format(date=target.isoformat(), lines=lines))
+    except Exception as e:
+        traceback.print_exc()
+        bot.reply_to(m, KZ["error"].format(err=str(e)))
+
 @bot.message_handler(content_types=["text"])
 def handle_text(m):
     user_id = m.from_user.id
@@ -373,71 +2474,62 @@ def handle_text(m):
 
         intent = detect_intent(text)
 
+        # 撤销 / 重做（多步）
+        if intent in ("undo", "redo"):
+            if WRITER.undo(user_id, intent).result():
+                bot.reply_to(m, KZ[f"{intent}_ok"])
+            else:
+                bot.reply_to(m, KZ[f"nothing_to_{intent}"])
+            return
+
         # 删除最后 N 条
         if intent == "delete_last":
             nmatch = re.search(r'(\d+)', text)
             n = int(nmatch.group(1)) if nmatch else 1
-            data = load_data()
-            removed = 0
-            for i in range(len(data["transactions"]) - 1, -1, -1):
-                if removed >= n:
-                    break
-                if data["transactions"][i].get("user_id") == user_id:
-                    data["transactions"].pop(i)
-                    removed += 1
-            save_data(data)
-            bot.reply_to(m, KZ["deleted_ok"].format(n=removed))
+            deleted = WRITER.delete_last(user_id, n).result()
+            bot.reply_to(m, KZ["deleted_ok"].format(n=deleted))
             return
 
         # 导出 / 发送文件请求
         if intent == "file_request" or intent == "export":
             # 检查是否是“今天的”“指定日期的”或文件名
-            if "бүгін" in text.lower() or "today" in text.lower():
-                target = date.today()
-                trans = list_transactions_for_date(user_id, target)
-                if not trans:
-                    bot.reply_to(m, KZ["no_transactions"])
-                    return
-                fname = f"export_{user_id}_{target.isoformat()}.csv"
-                path = export_transactions_to_csv(trans, fname)
-                bot.send_document(m.chat.id, open(path, "rb"))
-                bot.reply_to(m, KZ["export_ready"])
+            low = text.lower()
+            fmt = "xlsx" if ("xlsx" in low or "excel" in low) else "csv"
+            if "бүгін" in low or "today" in low:
+                send_export(m, user_id, date.today(), date.today(), fmt)
                 return
             # try find file by name or date tokens
             f = find_file_by_name_or_date(user_id, text)
             if f:
                 try:
-                    bot.send_document(m.chat.id, open(f["path"], "rb"))
+                    send_stored_file(m, f)
                     return
                 except Exception as e:
                     bot.reply_to(m, KZ["error"].format(err=str(e)))
                     return
-            # fallback: export for date if specified
-            mdate = re.search(r'(\d{4}-\d{2}-\d{2})', text)
-            if mdate:
-                target = datetime.fromisoformat(mdate.group(1)).date()
-                trans = list_transactions_for_date(user_id, target)
-                if not trans:
-                    bot.reply_to(m, KZ["no_transactions"])
-                    return
-                fname = f"export_{user_id}_{target.isoformat()}.csv"
-                path = export_transactions_to_csv(trans, fname)
-                bot.send_document(m.chat.id, open(path, "rb"))
-                bot.reply_to(m, KZ["export_ready"])
+            # fallback: export for date (or FROM TO range) if specified
+            dates = re.findall(r'(\d{4}-\d{2}-\d{2})', text)
+            if dates:
+                start, end = sorted(datetime.fromisoformat(d).date() for d in (dates[:2] if len(dates) >= 2 else dates * 2))
+                send_export(m, user_id, start, end, fmt)
                 return
             bot.reply_to(m, KZ["file_not_found"])
             return
 
         # 查询（今天/指定日期）
         if intent == "query":
+            dates = re.findall(r'(\d{4}-\d{2}-\d{2})', text)
+            if len(dates) >= 2:
+                start, end = sorted(datetime.fromisoformat(d).date() for d in dates[:2])
+                inc, exp = summary_for_range(user_id, start, end)
+                bot.reply_to(m, KZ["range_summary"].format(start=start, end=end, inc=inc, exp=exp, net=inc-exp))
+                return
             if re.search(r'\b(бүгін|today)\b', text.lower()):
                 target = date.today()
+            elif dates:
+                target = datetime.fromisoformat(dates[0]).date()
             else:
-                mdate = re.search(r'(\d{4}-\d{2}-\d{2})', text)
-                if mdate:
-                    target = datetime.fromisoformat(mdate.group(1)).date()
-                else:
-                    target = date.today()
+                target = date.today()
             inc, exp = totals_for_period(user_id, target, target)
             bot.reply_to(m, KZ["today_summary"].format(inc=inc, exp=exp, net=inc-exp))
             return
@@ -448,78 +2540,77 @@ def handle_text(m):
             mnum = re.search(r'(\d+(?:[.,]\d+)?)(?!.*\d)', text.replace(",", "."))
             if mnum:
                 val = float(mnum.group(1).replace(",", "."))
-                data = load_data()
-                for i in range(len(data["transactions"]) - 1, -1, -1):
-                    if data["transactions"][i].get("user_id") == user_id:
-                        data["transactions"][i]["data"]["amount"] = val
-                        save_data(data)
-                        bot.reply_to(m, KZ["edited_ok"])
-                        return
+                if WRITER.edit_last(user_id, {"amount": val}).result():
+                    bot.reply_to(m, KZ["edited_ok"])
+                    return
             # 修改最后类型（"make last expense"）
             if any(w in text.lower() for w in ["expense","шығыс","шық","төл"]):
-                data = load_data()
-                for i in range(len(data["transactions"]) - 1, -1, -1):
-                    if data["transactions"][i].get("user_id") == user_id:
-                        data["transactions"][i]["data"]["type"] = "expense"
-                        save_data(data)
-                        bot.reply_to(m, KZ["edited_ok"])
-                        return
+                if WRITER.edit_last(user_id, {"type": "expense"}).result():
+                    bot.reply_to(m, KZ["edited_ok"])
+                    return
             if any(w in text.lower() for w in ["income","кіріс","алды","табыс"]):
-                data = load_data()
-                for i in range(len(data["transactions"]) - 1, -1, -1):
-                    if data["transactions"][i].get("user_id") == user_id:
-                        data["transactions"][i]["data"]["type"] = "income"
-                        save_data(data)
-                        bot.reply_to(m, KZ["edited_ok"])
-                        return
+                if WRITER.edit_last(user_id, {"type": "income"}).result():
+                    bot.reply_to(m, KZ["edited_ok"])
+                    return
             bot.reply_to(m, "Өңдеу форматын түсінбедім. Мысал: 'change last to 3000' немесе 'последний 3000'.")
             return
 
         # 默认：尝试把消息解析为交易（可生成多笔）
         txs, unknowns = parse_message_to_transactions(text)
-        # 如果本地解析为空，调用备援（Ollama）
+        # 如果本地解析为空，异步调用备援（Ollama），结果出来后再回复
         if not txs and not unknowns:
-            model_resp = call_ollama_for_transaction(text)
-            if "json" in model_resp:
-                payload = model_resp["json"]
-                if isinstance(payload, dict) and payload.get("amount") is not None:
-                    txs = [{
-                        "type": payload.get("type","expense"),
-                        "amount": float(payload.get("amount")),
-                        "currency": payload.get("currency","KZT"),
-                        "date": payload.get("date", date.today().isoformat()),
-                        "description": payload.get("description", text[:240])
-                    }]
-                elif isinstance(payload, list):
-                    for obj in payload:
-                        if obj.get("amount"):
-                            txs.append({"type":obj.get("type","expense"), "amount":float(obj.get("amount")), "currency":obj.get("currency","KZT"), "date":obj.get("date", date.today().isoformat()), "description":obj.get("description", text[:240])})
-            else:
-                # fallback: first numeric token
-                fb = find_numbers_with_positions(text)
-                if fb:
-                    txs = [{"type":"expense","amount":fb[0][0],"currency":"KZT","date":date.today().isoformat(),"description":text[:240]}]
-
-        if txs:
-            saved = save_transactions(user_id, text, txs)
-            inc = sum([t["data"]["amount"] for t in saved if t["data"]["type"]=="income"])
-            exp = sum([t["data"]["amount"] for t in saved if t["data"]["type"]!="income"])
-            net = inc - exp
-            lines=[]
-            for i,t in enumerate(saved,1):
-                typ = "Кіріс" if t["data"]["type"]=="income" else "Шығыс"
-                lines.append(f"{i}) {typ} - {t['data']['amount']:.2f} KZT - {t['data']['description'][:60]}")
-            # 如果有未确定项，先提示
-            resp_text = KZ["saved_multi"].format(n=len(saved), lines="\n".join(lines), inc=inc, exp=exp, net=net)
-            bot.reply_to(m, resp_text)
-            if unknowns:
-                items = "; ".join([f"{u['amount']} ({u['context'][:30]})" for u in unknowns])
-                bot.reply_to(m, KZ["ask_confirm_unknown"].format(items=items))
-            return
-        else:
-            bot.reply_to(m, KZ["no_amount"])
-            return
+            cached = llm_cache_lookup(text)
+            if cached is not None:
+                reply_saved(m, user_id, text, transactions_from_model(cached, text), [])
+                return
+            fut = submit_llm_parse(text)
+            if fut is not None:
+                bot.reply_to(m, KZ["llm_pending"])
+                fut.add_done_callback(lambda f: finish_llm_parse(m, user_id, text, f))
+                return
+            txs = numeric_fallback(text)
+        reply_saved(m, user_id, text, txs, unknowns)
+        return
+
+    except Exception as e:
+        traceback.print_exc()
+        try:
+            bot.reply_to(m, KZ["error"].format(err=str(e)))
+        except:
+            pass
+
+def transactions_from_model(payload: Any, text: str) -> List[Dict[str, Any]]:
+    txs=[]
+    if isinstance(payload, dict) and payload.get("amount") is not None:
+        txs = [{
+            "type": payload.get("type","expense"),
+            "amount": float(payload.get("amount")),
+            "currency": payload.get("currency","KZT"),
+            "date": payload.get("date", date.today().isoformat()),
+            "description": payload.get("description", text[:240])
+        }]
+    elif isinstance(payload, list):
+        for obj in payload:
+            if obj.get("amount"):
+                txs.append({"type":obj.get("type","expense"), "amount":float(obj.get("amount")), "currency":obj.get("currency","KZT"), "date":obj.get("date", date.today().isoformat()), "description":obj.get("description", text[:240])})
+    return txs
 
+def numeric_fallback(text: str) -> List[Dict[str, Any]]:
+    # fallback: first numeric token
+    fb = find_numbers_with_positions(text)
+    if fb:
+        return [{"type":"expense","amount":fb[0][0],"currency":"KZT","date":date.today().isoformat(),"description":text[:240]}]
+    return []
+
+def finish_llm_parse(m, user_id: int, text: str, fut: Future) -> None:
+    """在备援线程里执行：把模型结果（或数字回退）保存并回复。"""
+    try:
+        model_resp = fut.result()
+        if "json" in model_resp:
+            txs = transactions_from_model(model_resp["json"], text)
+        else:
+            txs = numeric_fallback(text)
+        reply_saved(m, user_id, text, txs, [])
     except Exception as e:
         traceback.print_exc()
         try:
@@ -527,46 +2618,119 @@ def handle_text(m):
         except:
             pass
 
+def reply_saved(m, user_id: int, text: str, txs: List[Dict[str, Any]], unknowns: List[Dict[str, Any]]) -> None:
+    if not txs:
+        bot.reply_to(m, KZ["no_amount"])
+        return
+    saved = save_transactions(user_id, text, txs)
+    inc = sum([t["data"]["amount"] for t in saved if t["data"]["type"]=="income"])
+    exp = sum([t["data"]["amount"] for t in saved if t["data"]["type"]!="income"])
+    net = inc - exp
+    lines=[]
+    for i,t in enumerate(saved,1):
+        typ = "Кіріс" if t["data"]["type"]=="income" else "Шығыс"
+        lines.append(f"{i}) {typ} - {t['data']['amount']:.2f} KZT - {t['data']['description'][:60]}")
+    # 如果有未确定项，先提示
+    resp_text = KZ["saved_multi"].format(n=len(saved), lines="\n".join(lines), inc=inc, exp=exp, net=net)
+    bot.reply_to(m, resp_text)
+    if unknowns:
+        items = "; ".join([f"{u['amount']} ({u['context'][:30]})" for u in unknowns])
+        bot.reply_to(m, KZ["ask_confirm_unknown"].format(items=items))
+
 @bot.message_handler(content_types=["document"])
 def handle_document(m):
     try:
         file_info = bot.get_file(m.document.file_id)
         file_name = m.document.file_name or f"uploaded_{int(time.time())}"
-        dest = os.path.join(FILES_DIR, f"{int(time.time())}_{file_name}")
-        downloaded = bot.download_file(file_info.file_path)
-        with open(dest, "wb") as f:
-            f.write(downloaded)
-        # 处理 Excel 文件：尝试从每行提取金额并保存为交易（作为默认行为）
-        if file_name.lower().endswith((".xls", ".xlsx")):
+        tmp = os.path.join(FILES_DIR, f".{uuid.uuid4().hex}.part")
+        # 直接流式写盘，不在内存里保留整个文件；再按内容哈希归档，重复上传不重复占盘
+        sha256 = download_to(telegram_file_url(file_info.file_path), tmp)
+        dest = store_upload(tmp, sha256, file_name)
+        # 处理 Excel/CSV 文件：分块提取金额并保存为交易（作为默认行为）
+        if file_name.lower().endswith(TABULAR_EXTS):
             try:
-                df = pd.read_excel(dest)
+                res = ingest_table_file(m.from_user.id, file_name, dest)
             except Exception:
-                # 如果无法解析则只索引文件
-                index_uploaded_file(m.from_user.id, file_name, dest)
+                traceback.print_exc()
+                # 一条都没存进去：只索引文件
+                index_uploaded_file(m.from_user.id, file_name, dest, m.document.file_id, sha256)
                 bot.reply_to(m, "Файл қабылданды, бірақ Excel оқу сәтсіз аяқталды — файл сақталды.")
                 return
-            extracted=[]
-            for idx, row in df.iterrows():
-                row_text = " ".join([str(x) for x in row.values if pd.notna(x)])
-                nums = find_numbers_with_positions(row_text)
-                if nums:
-                    val = nums[0][0]
-                    typ = "income" if any(w in row_text.lower() for w in INC_KW) else ("expense" if any(w in row_text.lower() for w in EXP_KW) else "expense")
-                    tx = {"type":typ,"amount":float(val),"currency":"KZT","date":date.today().isoformat(),"description":row_text[:240]}
-                    extracted.append(tx)
-            saved = save_transactions(m.from_user.id, f"excel:{file_name}", extracted)
-            index_uploaded_file(m.from_user.id, file_name, dest)
-            bot.reply_to(m, KZ["file_saved"].format(count=len(saved)))
+            index_uploaded_file(m.from_user.id, file_name, dest, m.document.file_id, sha256)
+            if res.error:
+                reply = KZ["file_partial"].format(count=res.count, err=res.error)
+            elif res.skipped:
+                reply = KZ["file_saved_dupes"].format(count=res.count, skipped=res.skipped)
+            else:
+                reply = KZ["file_saved"].format(count=res.count)
+            if res.dropped:
+                reply += "\n" + KZ["file_dropped"].format(dropped=res.dropped)
+            bot.reply_to(m, reply)
             return
         else:
-            index_uploaded_file(m.from_user.id, file_name, dest)
+            index_uploaded_file(m.from_user.id, file_name, dest, m.document.file_id, sha256)
             bot.reply_to(m, "Файл қабылданды және сақталды.")
     except Exception as e:
         traceback.print_exc()
         bot.reply_to(m, KZ["error"].format(err=str(e)))
 
+# -------------------- Webhook 模式 --------------------
+def make_webhook_handler(dispatcher: UpdateDispatcher, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                self.send_error(403)
+                return
+            try:
+                update = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            except ValueError:
+                self.send_error(400)
+                return
+            if dispatcher.submit(update) == "busy":
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return WebhookHandler
+
+def process_update(update: Dict[str, Any]) -> None:
+    bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+def run_webhook(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+    # 并发和顺序由 UpdateDispatcher 负责，telebot 自己不再另开线程池
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(process_update)
+    server = ThreadingHTTPServer((host, port), make_webhook_handler(dispatcher))
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    print(f"Webhook: http://{host}:{port}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.shutdown()
+
 # -------------------- 启动 --------------------
 if __name__ == "__main__":
+    # 一次性迁移：python finance_bot_ai.py migrate [finance_data.json] [finance.db]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        src = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DATA_FILE
+        dst = sys.argv[3] if len(sys.argv) > 3 else SQLITE_FILE
+        print("Көшіру аяқталды:", migrate_json_to_sqlite(src, dst))
+        sys.exit(0)
+    # 手动归档：python finance_bot_ai.py archive [days]
+    if len(sys.argv) > 1 and sys.argv[1] == "archive":
+        print("Мұрағатталды (сөйлесу, жазба):", archive_old_records(int(sys.argv[2]) if len(sys.argv) > 2 else RETENTION_DAYS))
+        sys.exit(0)
     # 安全提醒（如果 token 看起来已暴露）
     if BOT_TOKEN and "PUT_YOUR" not in BOT_TOKEN:
         print("注意：请确保 BOT_TOKEN 未在公开场合泄露。如已泄露，请在 BotFather 上重置 token。")
@@ -576,9 +2740,14 @@ if __name__ == "__main__":
         requests.get(OLLAMA_URL, timeout=1)
     except:
         print("OLLAMA 服务不可达（若不使用本地 LLM 可忽略）。")
+    threading.Thread(target=retention_loop, daemon=True).start()
+    # webhook 模式：python finance_bot_ai.py webhook [port]
+    if len(sys.argv) > 1 and sys.argv[1] == "webhook":
+        run_webhook(port=int(sys.argv[2]) if len(sys.argv) > 2 else WEBHOOK_PORT)
+        sys.exit(0)
     while True:
         try:
             bot.polling(none_stop=True)
-        except Exception as e:
+        except Exception:
             traceback.print_exc()
             time.sleep(2)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 两个机器人在导入时就创建 Bot 对象，需要一个格式正确的 token（不会真的连 Telegram）
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("API_TOKEN", "123:test")
+
+
+@pytest.fixture(scope="session")
+def fba_module(tmp_path_factory):
+    # 模块导入时会在当前目录创建 data/，换到临时目录里导入
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("import"))
+    try:
+        import finance_bot_ai
+    finally:
+        os.chdir(cwd)
+    return finance_bot_ai
+
+
+@pytest.fixture(scope="session")
+def bot_module():
+    import bot
+    return bot
+
+
+@pytest.fixture
+def botdb(bot_module, tmp_path, monkeypatch):
+    """返回 run(body)：在临时目录里建库并打开 bot.DB，执行 await body(bot) 后关库。"""
+    b = bot_module
+    monkeypatch.chdir(tmp_path)
+
+    def run(body):
+        async def main():
+            await b.init_db()
+            db = b.Database("finance.db")
+            await db.open()
+            monkeypatch.setattr(b, "DB", db)
+            try:
+                return await body(b)
+            finally:
+                await db.close()
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.fixture
+def fba(fba_module, tmp_path, monkeypatch):
+    """返回 use(mode)：把 finance_bot_ai 的数据目录指到 tmp_path，并换上全新的存储和内存索引。"""
+    m = fba_module
+
+    def use(mode="single"):
+        data = tmp_path / mode
+        (data / "files").mkdir(parents=True)
+        paths = {
+            "SAVE_MODE": mode,
+            "DATA_DIR": str(data),
+            "FILES_DIR": str(data / "files"),
+            "DEFAULT_DATA_FILE": str(data / "finance_data.json"),
+            "SQLITE_FILE": str(data / "finance.db"),
+            "JOURNAL_FILE": str(data / "finance_journal.jsonl"),
+            "SHARD_DIR": str(data / "shards"),
+            "ARCHIVE_DIR": str(data / "archive"),
+        }
+        for name, value in paths.items():
+            monkeypatch.setattr(m, name, value)
+        monkeypatch.setattr(m, "_STORE", None)
+        monkeypatch.setattr(m, "_ARCHIVE_CACHE", type(m._ARCHIVE_CACHE)())
+        for name in ("TX_INDEX", "ANALYTICS", "FILE_CATALOG", "DATA_VERSIONS", "UNDO_LOG", "EXPORT_CACHE"):
+            monkeypatch.setattr(m, name, type(getattr(m, name))())
+        return m
+
+    return use
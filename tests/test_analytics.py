@@ -0,0 +1,45 @@
+import random
+from datetime import date, timedelta
+
+WORDS = ["такси", "кофе", "азық", "жалақы", "кафе"]
+
+
+def brute(m, user_id, start, end):
+    recs = [r for r in m.TX_INDEX.range(user_id, start, end)]
+    exp = [r["data"] for r in recs if r["data"]["type"] != "income"]
+    weeks = {}
+    for r in recs:
+        d = date.fromordinal(m.tx_ordinal(r))   # 索引按记录时间戳归日
+        key = d - timedelta(days=d.weekday())
+        slot = weeks.setdefault(key, [0.0, 0.0])
+        slot[0 if r["data"]["type"] == "income" else 1] += r["data"]["amount"]
+    top = sorted((t["amount"] for t in exp), reverse=True)[:5]
+    return sorted((k, a, b) for k, (a, b) in weeks.items()), top, sum(t["amount"] for t in exp)
+
+
+def test_columns_match_brute_force_per_user(fba):
+    m = fba("single")
+    rnd = random.Random(7)
+    start = date.today() - timedelta(days=60)
+    for user_id in (1, 2):
+        ops = []
+        for i in range(300):
+            day = start + timedelta(days=rnd.randint(0, 60))
+            ops.append(m.add_op("transactions", {
+                "id": f"{user_id}-{i}", "user_id": user_id, "timestamp": day.isoformat() + "T12:00:00+00:00", "source_text": "seed",
+                "data": {"type": rnd.choice(["income", "expense", "expense"]), "amount": float(rnd.randint(1, 9000)),
+                         "currency": "KZT", "date": day.isoformat(), "description": rnd.choice(WORDS)}}))
+        m.WRITER.append(user_id, ops, None, undoable=False).result()
+    # 先让分析视图加载，再删改：墓碑超过阈值时触发该用户的压缩
+    m.ANALYTICS.period_totals(1, start, date.today())
+    assert m.WRITER.delete_last(1, 200).result() == 200
+    m.WRITER.edit_last(1, {"amount": 12345.0, "type": "expense"}).result()
+    m.save_transactions(1, "late", [{"type": "expense", "amount": 10.0, "currency": "KZT", "date": start.isoformat(), "description": "кофе"}])
+
+    for user_id in (1, 2):
+        weeks, top, total = brute(m, user_id, start, date.today())
+        assert m.ANALYTICS.period_totals(user_id, start, date.today(), "week") == weeks
+        assert [a for _d, a, _s in m.ANALYTICS.top_expenses(user_id, start, date.today())] == top
+        cats = m.ANALYTICS.category_totals(user_id, start, date.today())
+        assert abs(sum(v for _c, v in cats) - total) < 1e-6
+    assert m.ANALYTICS._users[1].n < 300   # 已压缩
@@ -0,0 +1,164 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+
+class FakeMessage:
+    def __init__(self, edit_delay=0.0, **fields):
+        self.__dict__.update(fields)
+        self.edit_delay = edit_delay
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        await asyncio.sleep(self.edit_delay)
+        self.edits.append(text)
+
+
+def test_bulk_validates_before_writing(botdb):
+    async def body(b):
+        calls = []
+        rows = [("2025-10-01", "expense", 10.0)] * 2500
+        assert await b.save_transactions_bulk(rows, "excel", lambda done, total: calls.append(done)) == 2500
+        assert calls == [1000, 2000, 2500]
+        with pytest.raises(ValueError):
+            await b.save_transactions_bulk(rows + [("2025-10-01", "gift", 1.0)], "excel", calls.append)
+        assert calls == [1000, 2000, 2500]
+        return (await b.DB.fetchone("SELECT COUNT(*) FROM transactions"))[0]
+
+    assert botdb(body) == 2500
+
+
+def test_excel_progress_outside_transaction(botdb, monkeypatch):
+    pd.DataFrame({"Date": ["2025-10-01"] * 2500, "Type": ["expense"] * 2500, "Amount": [5.0] * 2500}).to_excel("big.xlsx", index=False)
+
+    async def body(b):
+        async def get_file(file_id):
+            return SimpleNamespace(file_path="x")
+
+        async def download_file(path, dest):
+            pass
+
+        monkeypatch.setattr(b.bot, "get_file", get_file, raising=False)
+        monkeypatch.setattr(b.bot, "download_file", download_file, raising=False)
+        monkeypatch.setattr(b, "PROGRESS_INTERVAL", 0.001)
+        # Telegram 很慢：每次编辑 1 秒。写事务不能等它
+        msg = FakeMessage(edit_delay=1.0, document=SimpleNamespace(file_name="big.xlsx", file_id="f1"),
+                          from_user=SimpleNamespace(id=1))
+        started = time.monotonic()
+        await b.handle_excel_file(msg)
+        elapsed = time.monotonic() - started
+        assert "2500 жазба сақталды" in msg.answers[-1]
+        assert all(e.startswith("⏳ Дайындалды") for e in msg.edits)
+        assert elapsed < 1.5
+        return (await b.DB.fetchone("SELECT COUNT(*) FROM transactions"))[0]
+
+    assert botdb(body) == 2500
+
+
+class FixedDate(__import__("datetime").date):
+    @classmethod
+    def today(cls):
+        return cls(2025, 10, 8)  # 周三
+
+
+def test_parse_date_normalizes_formats(bot_module):
+    b = bot_module
+    for raw in ("2025-10-04", "2025-10-04 12:30:00", "04.10.2025", "04/10/2025", "2025/10/04", "04.10.25"):
+        assert b.parse_date(raw).isoformat() == "2025-10-04"
+    assert b.parse_date("ертең") is None
+    assert b.parse_date(None) is None
+
+
+def test_range_week_and_month_reports(botdb, monkeypatch):
+    async def body(b):
+        monkeypatch.setattr(b, "date", FixedDate)
+        await b.save_transactions_bulk([
+            ("2025-09-30", "income", 1000.0),   # 上个月
+            ("2025-10-01", "expense", 50.0),    # 本月、上周
+            ("2025-10-06", "income", 300.0),    # 本周一
+            ("08.10.2025", "expense", 20.0),    # 本周三，日.月.年
+            ("2025-10-09", "income", 7.0),      # 明天，不在 /week /month 内
+        ], "excel", lambda done, total: None)
+        replies = {}
+        for text in ("/summary 2025-10-01 2025-10-06", "/summary 2025-10-06 01.10.2025",
+                     "/summary 08.10.2025", "/summary 2025-10-01 xx", "/week", "/month"):
+            msg = FakeMessage(text=text)
+            handler = {"/week": b.cmd_week, "/month": b.cmd_month}.get(text, b.cmd_summary)
+            await handler(msg)
+            replies[text] = msg.answers[-1]
+        return replies
+
+    r = botdb(body)
+    assert "2025-10-01 — 2025-10-06" in r["/summary 2025-10-01 2025-10-06"]
+    assert "Кіріс: 300.00" in r["/summary 2025-10-01 2025-10-06"] and "Шығын: 50.00" in r["/summary 2025-10-01 2025-10-06"]
+    assert r["/summary 2025-10-06 01.10.2025"] == r["/summary 2025-10-01 2025-10-06"]
+    assert "2025-10-08" in r["/summary 08.10.2025"] and "Шығын: 20.00" in r["/summary 08.10.2025"]
+    assert r["/summary 2025-10-01 xx"].startswith("❌")
+    assert "2025-10-06 — 2025-10-08" in r["/week"]
+    assert "Кіріс: 300.00" in r["/week"] and "Шығын: 20.00" in r["/week"]
+    assert "2025-10-01 — 2025-10-08" in r["/month"]
+    assert "Кіріс: 300.00" in r["/month"] and "Шығын: 70.00" in r["/month"] and "Баланс: 230.00" in r["/month"]
+
+
+def test_init_db_migrates_old_date_formats(bot_module, tmp_path, monkeypatch):
+    import sqlite3
+    b = bot_module
+    monkeypatch.chdir(tmp_path)
+    con = sqlite3.connect("finance.db")
+    con.execute("CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, date TEXT, type TEXT, amount REAL, source TEXT)")
+    con.executemany("INSERT INTO transactions (date, type, amount, source) VALUES (?, ?, ?, 'manual')",
+                    [("04.10.2025", "income", 100.0), ("2025-10-04", "expense", 30.0), ("2025/10/05", "expense", 5.0)])
+    con.commit()
+    con.close()
+
+    asyncio.run(b.init_db())
+
+    con = sqlite3.connect("finance.db")
+    rows = con.execute("SELECT date, day FROM transactions ORDER BY id").fetchall()
+    daily = con.execute("SELECT day, income, expense FROM daily_totals ORDER BY day").fetchall()
+    monthly = con.execute("SELECT month, income, expense FROM monthly_totals").fetchall()
+    con.close()
+    assert [d for d, _ in rows] == ["2025-10-04", "2025-10-04", "2025-10-05"]
+    assert [o for _, o in rows] == [b.day_ordinal(d) for d, _ in rows]
+    assert daily == [("2025-10-04", 100.0, 30.0), ("2025-10-05", 0.0, 5.0)]
+    assert monthly == [("2025-10", 100.0, 35.0)]
+
+
+def test_excel_parsed_in_real_process_pool(botdb, monkeypatch):
+    pd.DataFrame({"Date": ["2025-10-01", "02.10.2025"], "Type": ["income", "expense"], "Amount": [100.0, 40.0]}).to_excel("pool.xlsx", index=False)
+
+    async def body(b):
+        async def get_file(file_id):
+            return SimpleNamespace(file_path="x")
+
+        async def download_file(path, dest):
+            pass
+
+        monkeypatch.setattr(b.bot, "get_file", get_file, raising=False)
+        monkeypatch.setattr(b.bot, "download_file", download_file, raising=False)
+        # 和 main() 一样：数据库（aiosqlite 线程）已打开之后才起进程池
+        pool = b.OffloadPool(workers=1)
+        monkeypatch.setattr(b, "OFFLOAD", pool)
+        pool.start()
+        executor = pool._executor
+        try:
+            assert executor._mp_context.get_start_method() == "spawn"
+            msg = FakeMessage(document=SimpleNamespace(file_name="pool.xlsx", file_id="f2"),
+                              from_user=SimpleNamespace(id=1))
+            await asyncio.wait_for(b.handle_excel_file(msg), 60)
+        finally:
+            pool.shutdown()
+            executor.shutdown(wait=True)
+        assert "2 жазба сақталды" in msg.answers[-1], msg.answers
+        assert pool.depth == 0
+        return await b.DB.fetchall("SELECT date, type, amount FROM transactions ORDER BY id")
+
+    assert botdb(body) == [("2025-10-01", "income", 100.0), ("2025-10-02", "expense", 40.0)]
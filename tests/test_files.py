@@ -0,0 +1,112 @@
+from datetime import date
+from types import SimpleNamespace
+
+
+class FakeTelegram:
+    """记录 send_document 的第一个参数：字符串是复用的 file_id，否则是上传的文件对象。"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_document(self, chat_id, doc, **kwargs):
+        self.sent.append(doc if isinstance(doc, str) else "upload")
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"tg{len(self.sent)}"))
+
+    def reply_to(self, m, text, **kwargs):
+        pass
+
+
+def fake_telegram(m, monkeypatch):
+    tg = FakeTelegram()
+    monkeypatch.setattr(m.bot, "send_document", tg.send_document)
+    monkeypatch.setattr(m.bot, "reply_to", tg.reply_to)
+    return tg
+
+
+def test_find_file_ignores_digits_and_extensions(fba):
+    m = fba("single")
+    m.index_uploaded_file(1, "bank_2025.xlsx", "/tmp/a")
+    m.index_uploaded_file(1, "2024.csv", "/tmp/b")
+    m.index_uploaded_file(1, "kaspi statement.xlsx", "/tmp/c")
+
+    # 日期片段、扩展名都不算重合：这两条应当落到日期导出
+    assert m.find_file_by_name_or_date(1, "export 2025-10-04") is None
+    assert m.find_file_by_name_or_date(1, "export 2025-10-04 2025-10-10 xlsx") is None
+
+    assert m.find_file_by_name_or_date(1, "bank файлын жібер")["path"] == "/tmp/a"
+    assert m.find_file_by_name_or_date(1, "send bank_2025.xlsx")["path"] == "/tmp/a"
+    assert m.find_file_by_name_or_date(1, "файл 2024.csv берші")["path"] == "/tmp/b"
+    assert m.find_file_by_name_or_date(1, "kaspi statement")["path"] == "/tmp/c"
+
+
+def test_find_file_by_full_name_inside_cjk_text(fba):
+    m = fba("single")
+    m.index_uploaded_file(1, "账单.xlsx", "/tmp/a")
+    m.index_uploaded_file(1, "其他.csv", "/tmp/b")
+
+    # 中文没有空格：整句只切出“把账单”“xlsx发给我”两个词元，和文件名一个都不重合
+    assert m.find_file_by_name_or_date(1, "把账单.xlsx发给我")["path"] == "/tmp/a"
+    assert m.find_file_by_name_or_date(1, "请发送其他.csv")["path"] == "/tmp/b"
+
+
+def test_find_file_substring_fallback_for_suffixed_names(fba):
+    m = fba("single")
+    m.index_uploaded_file(1, "statements_october.xlsx", "/tmp/a")
+    m.index_uploaded_file(1, "kaspibank.csv", "/tmp/b")
+    m.index_uploaded_file(1, "notes.txt", "/tmp/c")
+
+    assert m.find_file_by_name_or_date(1, "send statement")["path"] == "/tmp/a"
+    assert m.find_file_by_name_or_date(1, "kaspi файлын жібер")["path"] == "/tmp/b"
+    # 有词元重合时仍按重合数，不走子串
+    assert m.find_file_by_name_or_date(1, "notes please")["path"] == "/tmp/c"
+    assert m.find_file_by_name_or_date(1, "export 2025-10-04 xlsx") is None
+
+
+def test_export_file_id_reused_until_data_changes(fba, monkeypatch):
+    m = fba("single")
+    tg = fake_telegram(m, monkeypatch)
+    msg = SimpleNamespace(chat=SimpleNamespace(id=1))
+    today = date.today()
+    tx = {"type": "expense", "amount": 100, "currency": "KZT", "date": today.isoformat(), "description": "такси"}
+    m.save_transactions(1, "такси 100", [tx])
+
+    m.send_export(msg, 1, today, today, "csv")
+    m.send_export(msg, 1, today, today, "csv")
+    m.send_export(msg, 1, today, today, "xlsx")   # 格式不同，单独缓存
+    assert tg.sent == ["upload", "tg1", "upload"]
+
+    m.save_transactions(1, "такси 100", [tx])     # 数据版本变了，旧 file_id 作废
+    m.send_export(msg, 1, today, today, "csv")
+    m.send_export(msg, 1, today, today, "csv")
+    assert tg.sent[3:] == ["upload", "tg4"]
+    m.send_export(msg, 2, today, today, "csv")    # 别的用户不受影响，也没有数据
+    assert len(tg.sent) == 5
+
+
+def test_stored_file_reuses_file_id(fba, monkeypatch, tmp_path):
+    m = fba("single")
+    tg = fake_telegram(m, monkeypatch)
+    msg = SimpleNamespace(chat=SimpleNamespace(id=1))
+    m.index_uploaded_file(1, "fresh.xlsx", str(tmp_path / "missing.xlsx"), file_id="up1")
+    old = tmp_path / "old.xlsx"
+    old.write_bytes(b"x")
+    m.index_uploaded_file(1, "old.xlsx", str(old))
+
+    # 上传时记下的 file_id 直接用，磁盘文件不再打开
+    m.send_stored_file(msg, m.find_file_by_name_or_date(1, "fresh.xlsx"))
+    # 旧记录没有 file_id：第一次上传，之后复用
+    m.send_stored_file(msg, m.find_file_by_name_or_date(1, "old.xlsx"))
+    m.send_stored_file(msg, m.find_file_by_name_or_date(1, "old.xlsx"))
+    assert tg.sent == ["up1", "upload", "tg2"]
+
+
+def test_catalog_ignores_file_already_loaded_from_disk(fba):
+    m = fba("single")
+    ops = [m.add_op("files", {"id": "f1", "user_id": 1, "timestamp": "2025-10-04T00:00:00+00:00",
+                              "filename": "bank.xlsx", "path": "/tmp/a"})]
+    # commit_ops 先落盘再同步目录：首次加载恰好落在两步之间时，同一文件会来两次
+    m.get_store().apply(ops)
+    assert m.FILE_CATALOG.find(1, "bank")["id"] == "f1"
+    m.FILE_CATALOG.apply(ops)
+    assert [f["id"] for f in m.FILE_CATALOG._users[1].files] == ["f1"]
+    assert m.FILE_CATALOG._users[1].by_token["bank"] == [0]
@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+
+
+def test_to_amounts_separators(fba_module):
+    col = pd.Series(["1,234.56", "1.234,56", "1 234,5", "1,234,567", "12,5", "-300", "abc", ""])
+    out = fba_module.to_amounts(col).tolist()
+    assert out[:6] == [1234.56, 1234.56, 1234.5, 1234567.0, 12.5, -300.0]
+    assert pd.isna(out[6]) and pd.isna(out[7])
+
+
+def test_ingest_reports_dropped_rows(fba, tmp_path):
+    m = fba("single")
+    path = tmp_path / "bank.csv"
+    pd.DataFrame({
+        "Дата": ["2025-10-01", "2025-10-02", "2025-10-03", "2025-10-04"],
+        "Сумма": ["-1,234.56", "тексеру", "", "-500"],
+        "Описание": ["магазин", "кафе", "баланс", "такси"],
+    }).to_csv(path, index=False)
+    assert m.ingest_table_file(1, "bank.csv", str(path)) == (2, 0, 1, None)
+    assert sorted(t["data"]["amount"] for t in m.TX_INDEX.last(1, 5)) == [500.0, 1234.56]
+
+
+def test_partial_ingest_then_reupload(fba, tmp_path, monkeypatch):
+    m = fba("single")
+    path = tmp_path / "bank.csv"
+    pd.DataFrame({"Дата": ["2025-10-0%d" % d for d in range(1, 5)],
+                  "Сумма": ["-100", "-200", "-300", "-400"],
+                  "Описание": ["a", "b", "c", "d"]}).to_csv(path, index=False)
+    real = m.iter_table_chunks
+
+    def broken(p):
+        chunks = real(p, chunk_rows=2)
+        yield next(chunks)
+        raise ValueError("bad row")
+
+    monkeypatch.setattr(m, "iter_table_chunks", broken)
+    assert m.ingest_table_file(1, "bank.csv", str(path)) == (2, 0, 0, "bad row")
+    monkeypatch.setattr(m, "iter_table_chunks", real)
+    assert m.ingest_table_file(1, "bank.csv", str(path)) == (2, 2, 0, None)
+
+
+def test_ingest_fails_before_first_save(fba, tmp_path):
+    m = fba("single")
+    path = tmp_path / "broken.xlsx"
+    path.write_bytes(b"not a zip")
+    with pytest.raises(Exception):
+        m.ingest_table_file(1, "broken.xlsx", str(path))
+
+
+@pytest.mark.parametrize("mode", ["single", "daily", "journal", "sqlite", "sharded"])
+def test_imported_statement_lands_on_its_own_days(fba, tmp_path, mode):
+    from datetime import date
+    m = fba(mode)
+    path = tmp_path / "bank.csv"
+    pd.DataFrame({"Дата": ["2025-10-01", "2025-10-01", "2025-10-02"],
+                  "Сумма": ["-100", "-50", "-150"],
+                  "Описание": ["такси", "кофе", "азық"]}).to_csv(path, index=False)
+    assert m.ingest_table_file(1, "bank.csv", str(path)).count == 3
+    d1, d2 = date(2025, 10, 1), date(2025, 10, 2)
+    assert m.totals_for_period(1, d1, d1) == (0.0, 150.0)
+    assert m.totals_for_period(1, d2, d2) == (0.0, 150.0)
+    assert m.totals_for_period(1, date.today(), date.today()) == (0.0, 0.0)
+    assert [d for d, _inc, _exp in m.ANALYTICS.period_totals(1, d1, d2, "month")] == [d1]
+    assert len(m.list_transactions_for_date(1, d1)) == 2
+    # 重新打开存储、从磁盘重建索引，结果一样
+    m._STORE = None
+    m.TX_INDEX = type(m.TX_INDEX)()
+    assert m.totals_for_period(1, d1, d1) == (0.0, 150.0)
+    # 删改按账目日期所在的分区找得到
+    assert m.WRITER.delete_last(1, 1).result() == 1
+    assert m.totals_for_period(1, d2, d2) == (0.0, 0.0)
+
+
+def test_signed_amounts_and_day_first_dates(fba_module):
+    m = fba_module
+    df = pd.DataFrame({"Дата": ["01.10.2025", "15/10/2025", "2025-10-03 12:00"],
+                       "Сумма": ["- 5 000,00 ₸", "+ 20 000,00 ₸", "1 200,00 ₸"],
+                       "Описание": ["Покупка", "Пополнение", "Кешбэк"]})
+    txs, dropped = m.extract_transactions_from_frame(df)
+    assert dropped == 0
+    # 有负数的列是带符号流水：正数是入账，哪怕描述里没有收入关键词
+    assert [(t["type"], t["amount"], t["date"]) for t in txs] == [
+        ("expense", 5000.0, "2025-10-01"), ("income", 20000.0, "2025-10-15"), ("income", 1200.0, "2025-10-03")]
+    # 只有一笔写了 "+"：它是收入，其余无符号的仍按关键词
+    txs, _ = m.extract_transactions_from_frame(pd.DataFrame({"Сумма": ["+500", "700"], "Описание": ["x", "такси"]}))
+    assert [t["type"] for t in txs] == ["income", "expense"]
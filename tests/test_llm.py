@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ANSWER = '[{"type": "expense", "amount": 2000, "currency": "KZT", "description": "такси"}]'
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    """假的 /api/generate：先分几行吐出 JSON，再慢慢吐一段永远不会被用到的尾巴。"""
+    head_delay = 0.0
+    tail_lines = 15
+    tail_delay = 0.2
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        type(self).requests.append(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        time.sleep(self.head_delay)
+        try:
+            for i in range(0, len(ANSWER), 16):
+                self._line({"response": ANSWER[i:i + 16], "done": False})
+            for _ in range(self.tail_lines):
+                time.sleep(self.tail_delay)
+                self._line({"response": " ", "done": False})
+            self._line({"response": "", "done": True})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _line(self, obj):
+        self.wfile.write(json.dumps(obj).encode() + b"\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ollama(fba, tmp_path, monkeypatch):
+    m = fba("single")
+    monkeypatch.setattr(m, "LLM_CACHE", m.LLMCache(str(tmp_path / "llm_cache.json")))
+    StubOllama.requests = []
+    monkeypatch.setattr(StubOllama, "head_delay", 0.0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield m, "http://127.0.0.1:%d/api/generate" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_stream_stops_at_first_json(ollama):
+    m, endpoint = ollama
+    started = time.monotonic()
+    resp = m.call_ollama_for_transaction("такси 2000", endpoint=endpoint)
+    elapsed = time.monotonic() - started
+    assert resp["json"] == json.loads(ANSWER)
+    # 尾巴要 3 秒才吐完；配平后立即断开就不用等
+    assert elapsed < 1.0
+
+
+def test_pool_parse_and_template_cache(ollama):
+    m, endpoint = ollama
+    fut = m.submit_llm_parse("такси 2000", endpoint)
+    assert fut.result(timeout=5)["json"] == json.loads(ANSWER)
+    # 同一模板、不同数字：命中缓存，按新数字回填，不再请求模型
+    again = m.submit_llm_parse("такси 3500", endpoint).result(timeout=5)
+    assert again["cached"] and again["json"][0]["amount"] == 3500
+    assert len(StubOllama.requests) == 1
+    assert StubOllama.requests[0]["stream"] is True
+
+
+def test_pool_full_returns_none(ollama, monkeypatch):
+    m, endpoint = ollama
+    monkeypatch.setattr(StubOllama, "head_delay", 0.5)
+    monkeypatch.setattr(m, "_LLM_SLOTS", threading.BoundedSemaphore(1))
+    first = m.submit_llm_parse("такси 2000", endpoint)
+    assert m.submit_llm_parse("кафе 1500", endpoint) is None
+    assert "json" in first.result(timeout=5)
+    # 名额在完成回调里归还，回调可能比 result() 晚一点跑完
+    deadline = time.monotonic() + 2
+    while (fut := m.submit_llm_parse("кафе 1500", endpoint)) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fut is not None and "json" in fut.result(timeout=5)
+
+
+def test_unreachable_endpoint_reports_error(ollama):
+    m, _endpoint = ollama
+    resp = m.call_ollama_for_transaction("такси 2000", endpoint="http://127.0.0.1:9/api/generate")
+    assert "error" in resp and "json" not in resp
+
+
+def test_template_keeps_dates_relative(fba_module):
+    m = fba_module
+    from datetime import date, timedelta
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    tpl, nums, dates = m.message_template("кеше такси 2000")
+    cached = m.to_template({"amount": 2000, "date": yesterday, "description": "такси"}, nums, dates)
+    assert cached["date"] == {"$today": -1}
+    # 缓存放了一天之后再命中，仍然是“命中那天的昨天”
+    assert m.fill_template(cached, nums, dates)["date"] == yesterday
+
+    tpl, nums, dates = m.message_template("2025-10-04 такси 2000")
+    cached = m.to_template({"amount": 2000, "date": "2025-10-04"}, nums, dates)
+    assert cached["date"] == "<d0>"
+    _tpl, nums, dates = m.message_template("2025-11-01 такси 2000")
+    assert m.fill_template(cached, nums, dates)["date"] == "2025-11-01"
+
+    cached = m.to_template({"amount": 2000, "date": "today"}, nums, dates)
+    assert "date" not in cached
+    tx = m.transactions_from_model(m.fill_template(cached, nums, dates), "такси 2000")
+    assert tx[0]["date"] == date.today().isoformat()
@@ -0,0 +1,90 @@
+import random
+from types import SimpleNamespace
+
+
+def naive_nearest(m, text, pos):
+    """原来的逐词 in 子串实现，作为对照。"""
+    seg = text[max(0, pos - 40):min(len(text), pos + 40)].lower()
+    for scope in (seg, text.lower()):
+        if any(w in scope for w in m.INC_KW):
+            return "income"
+        if any(w in scope for w in m.EXP_KW):
+            return "expense"
+    return None
+
+
+def test_automaton_finds_every_occurrence(fba_module):
+    m = fba_module
+    rnd = random.Random(3)
+    words = m.INC_KW + m.EXP_KW
+    for _ in range(200):
+        low = "".join(rnd.choice(words + [" ", "x", "ы", "2000 "]) for _ in range(rnd.randint(0, 30))).lower()
+        expect = sorted({(i, i + len(w), label) for label, ws in (("income", m.INC_KW), ("expense", m.EXP_KW))
+                         for w in ws for i in range(len(low)) if low.startswith(w.lower(), i)})
+        assert sorted(set(m.KW_AUTOMATON.find(low))) == expect
+
+
+def test_nearest_keyword_matches_naive_scan(fba_module):
+    m = fba_module
+    rnd = random.Random(5)
+    words = m.INC_KW + m.EXP_KW + ["такси", "кофе", "бүгін", "және", "."]
+    for _ in range(300):
+        text = " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 25)))
+        for pos in (0, len(text) // 2, len(text)):
+            assert m.nearest_keyword_type(text, pos) == naive_nearest(m, text, pos), (text, pos)
+
+
+def test_lexer_clauses_and_numbers(fba_module):
+    m = fba_module
+    text = "такси 2 000 төледім және кофе 1,5k, жалақы 250000 алдым"
+    lx = m.lex_message(text)
+    assert [text[s:e].strip() for s, e in lx.clauses] == ["такси 2 000 төледім", "кофе 1,5k", "жалақы 250000 алдым"]
+    # 数字 token 先于分隔符匹配：1,5k 里的逗号是小数点，不切子句
+    assert [(v, raw, ci) for v, _s, _e, raw, ci in lx.numbers] == [(2000.0, "2 000", 0), (1500.0, "1,5k", 1), (250000.0, "250000", 2)]
+    for _v, s, e, raw, _ci in lx.numbers:
+        assert text[s:e] == raw
+
+
+def test_parse_message_types_each_clause(fba_module):
+    m = fba_module
+    txs, unknowns = m.parse_message_to_transactions("бүгін такси 2000 төледім")
+    assert [(t["type"], t["amount"], t["description"]) for t in txs] == [("expense", 2000.0, "бүгін такси 2000 төледім")]
+    txs, unknowns = m.parse_message_to_transactions("жерден 4000 таптым; дүкенде ұзақ тұрып сүт пен нанға 1500 жұмсадым")
+    assert [(t["type"], t["amount"]) for t in txs] == [("income", 4000.0), ("expense", 1500.0)]
+    assert unknowns == []
+    txs, unknowns = m.parse_message_to_transactions("такси 700")
+    assert txs == [] and [u["amount"] for u in unknowns] == [700.0]
+
+
+def test_undo_redo_only_as_whole_commands(fba_module):
+    m = fba_module
+    for text in ("/undo", "undo", "Отмена!", "болдырма", "/undo@finance_bot", " кері қайтар "):
+        assert m.detect_intent(text) == "undo", text
+    for text in ("/redo", "Redo", "повтори", "қайтала."):
+        assert m.detect_intent(text) == "redo", text
+    for text in ("ақшаны кері қайтарды 5000", "отменили заказ, вернули 5000 получил",
+                 "повторил платеж 3000 потратил", "credo 100 paid", "undo 500 такси"):
+        assert m.detect_intent(text) not in ("undo", "redo"), text
+
+
+def test_entries_with_undo_words_are_recorded(fba, monkeypatch):
+    m = fba("single")
+    replies = []
+    monkeypatch.setattr(m.bot, "reply_to", lambda msg, text, **kw: replies.append(text))
+
+    def send(text):
+        m.handle_text(SimpleNamespace(text=text, from_user=SimpleNamespace(id=1), chat=SimpleNamespace(id=1)))
+        return replies[-1]
+
+    send("такси 2000 төледім")
+    for text in ("ақшаны кері қайтарды 5000", "отменили заказ, вернули 5000 получил",
+                 "повторил платеж 3000 потратил", "credo 100 paid"):
+        reply = send(text)
+        assert reply not in (m.KZ["undo_ok"], m.KZ["redo_ok"], m.KZ["nothing_to_undo"], m.KZ["nothing_to_redo"]), text
+    amounts = [(t["data"]["type"], t["data"]["amount"]) for t in m.TX_INDEX.last(1, 10)]
+    assert amounts == [("expense", 100.0), ("expense", 3000.0), ("income", 5000.0), ("expense", 2000.0)]
+
+    # 明确的命令照常撤销 / 重做
+    assert send("/undo") == m.KZ["undo_ok"]
+    assert send("/redo") == m.KZ["redo_ok"]
+    assert len(m.TX_INDEX.last(1, 10)) == 4
@@ -0,0 +1,173 @@
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+MODES = ["single", "daily", "journal", "sqlite", "sharded"]
+
+
+def expense(amount):
+    return {"type": "expense", "amount": amount, "currency": "KZT", "date": date.today().isoformat(), "description": "такси"}
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_edit_then_totals(fba, mode):
+    m = fba(mode)
+    today = date.today()
+    m.save_transactions(1, "такси 2000", [expense(2000)])
+    assert m.WRITER.edit_last(1, {"amount": 5000}).result()
+    assert m.totals_for_period(1, today, today) == (0.0, 5000.0)
+    assert m.WRITER.delete_last(1, 1).result() == 1
+    assert m.totals_for_period(1, today, today) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_undo_redo_restores_totals(fba, mode):
+    m = fba(mode)
+    today = date.today()
+    m.save_transactions(1, "x", [expense(100)])
+    m.save_transactions(1, "x", [expense(200)])
+    assert m.WRITER.delete_last(1, 2).result() == 2
+    assert m.WRITER.undo(1).result()
+    assert m.totals_for_period(1, today, today) == (0.0, 300.0)
+    assert [t["data"]["amount"] for t in m.TX_INDEX.last(1, 5)] == [200, 100]
+    assert m.WRITER.redo(1).result()
+    assert m.totals_for_period(1, today, today) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_source_command_reads_archived_text(fba, mode, monkeypatch):
+    m = fba(mode)
+    replies = []
+    monkeypatch.setattr(m.bot, "reply_to", lambda msg, text, **kw: replies.append(text))
+    msg = SimpleNamespace(text=f"/source {date.today().isoformat()}", from_user=SimpleNamespace(id=1))
+    m.save_transactions(1, "такси 2000", [expense(2000)])
+    assert m.archive_old_records(days=-1) == (1, 1)
+    # 热存储里已经没有原始消息，/source 按需从归档读回；导出不带原始消息
+    assert "source_text" not in m.TX_INDEX.last(1, 1)[0]
+    m.cmd_source(msg)
+    assert "expense 2000.00 KZT — такси 2000" in replies[-1]
+    assert "source_text" not in m.EXPORT_COLUMNS
+
+
+@pytest.mark.parametrize("mode", ["sqlite", "sharded"])
+def test_first_query_reads_store_once(fba, mode, monkeypatch):
+    m = fba(mode)
+    today = date.today()
+    m.save_transactions(1, "такси 2000", [expense(2000)])
+    for name in ("TX_INDEX", "ANALYTICS"):
+        monkeypatch.setattr(m, name, type(getattr(m, name))())
+    store, reads = m.get_store(), []
+    real = store.transactions_for
+    monkeypatch.setattr(store, "transactions_for", lambda uid: reads.append(uid) or real(uid))
+    assert m.totals_for_period(1, today, today) == (0.0, 2000.0)
+    assert m.ANALYTICS.period_totals(1, today, today, "week")[0][2] == 2000.0
+    assert reads == [1]
+
+
+def journal_rec(i, user_id=1):
+    return {"id": f"t{i}", "user_id": user_id, "timestamp": "2025-10-01T10:00:00+00:00", "data": expense(i)}
+
+
+def test_journal_replay_drops_torn_tail(fba_module, tmp_path):
+    m = fba_module
+    snap, log = str(tmp_path / "snap.json"), str(tmp_path / "journal.jsonl")
+    store = m.JournalStore(snap, log)
+    store.apply([m.add_op("transactions", journal_rec(1)), m.add_op("transactions", journal_rec(2))])
+    store.apply([m.edit_op(1, "t1", {"amount": 111}), m.del_op(1, "t2")])
+    good = open(log, "rb").read()
+    # 崩溃时写了一半的最后一行
+    with open(log, "ab") as f:
+        f.write(b'{"op": "add", "kind": "transactions", "rec": {"id": "t3"')
+
+    reopened = m.JournalStore(snap, log)
+    assert [(t["id"], t["data"]["amount"]) for t in reopened.load()["transactions"]] == [("t1", 111)]
+    assert open(log, "rb").read() == good   # 半行被截掉，后续追加从干净的行尾开始
+    reopened.apply([m.add_op("transactions", journal_rec(4))])
+    assert [t["id"] for t in m.JournalStore(snap, log).load()["transactions"]] == ["t1", "t4"]
+
+
+def test_journal_compaction_keeps_state(fba_module, tmp_path):
+    m = fba_module
+    snap, log = str(tmp_path / "snap.json"), str(tmp_path / "journal.jsonl")
+    store = m.JournalStore(snap, log, compact_every=3)
+    for i in range(5):
+        store.apply([m.add_op("transactions", journal_rec(i))])
+    store.apply([m.del_op(1, "t0"), m.unset_op(1, "t1", ["data"])])
+    # 第 3 行时压缩过一次：日志只剩压缩之后的 op
+    assert sum(1 for _ in open(log, "rb")) < 5
+    ids = [t["id"] for t in m.JournalStore(snap, log).load()["transactions"]]
+    assert sorted(ids) == ["t1", "t2", "t3", "t4"]
+    assert "data" not in {t["id"]: t for t in m.JournalStore(snap, log).load()["transactions"]}["t1"]
+    # 压缩后再重放同一段日志也不会产生重复（按 id 覆盖）
+    store.compact()
+    assert open(log, "rb").read() == b""
+    assert sorted(t["id"] for t in m.JournalStore(snap, log).load()["transactions"]) == sorted(ids)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_edit_date_moves_totals(fba, mode):
+    m = fba(mode)
+    today, old = date.today(), date(2025, 10, 1)
+    m.save_transactions(1, "такси 2000", [expense(2000)])
+    assert m.WRITER.edit_last(1, {"date": old.isoformat()}).result()
+    assert m.totals_for_period(1, today, today) == (0.0, 0.0)
+    assert m.totals_for_period(1, old, old) == (0.0, 2000.0)
+    assert m.ANALYTICS.period_totals(1, old, old, "week")[0][2] == 2000.0
+    assert m.WRITER.delete_last(1, 1).result() == 1
+    assert m.totals_for_period(1, old, old) == (0.0, 0.0)
+
+
+def test_sqlite_store_is_fully_synchronous(fba):
+    m = fba("sqlite")
+    assert m.get_store()._conn.execute("PRAGMA synchronous").fetchone()[0] == 2   # FULL
+
+
+def test_migrate_json_and_journal_to_sqlite(fba_module, tmp_path):
+    m = fba_module
+    snap, log, db = str(tmp_path / "finance_data.json"), str(tmp_path / "journal.jsonl"), str(tmp_path / "finance.db")
+    store = m.JournalStore(snap, log, compact_every=3)
+    for i in range(4):
+        store.apply([m.add_op("transactions", journal_rec(i, user_id=1 + i % 2))])
+    store.apply([m.add_op("files", {"id": "f1", "user_id": 1, "filename": "a.xlsx"}),
+                 m.add_op("conversations", {"id": "c1", "user_id": 1, "timestamp": "2025-10-01T10:00:00+00:00", "text": "x"}),
+                 m.edit_op(1, "t0", {"amount": 999}), m.del_op(2, "t3")])
+    with open(log, "ab") as f:
+        f.write(b'{"op": "del"')   # 写了一半的行不迁移
+    # 快照里有 t0..t2，日志里有 t3 以及后面的改动
+    counts = m.migrate_json_to_sqlite(snap, db, log, batch=2)
+    assert counts["transactions"] == 3
+    sq = m.SqliteStore(db)
+    assert {t["id"]: t["data"]["amount"] for t in sq.transactions_for(1)} == {"t0": 999, "t2": 2}
+    assert [t["id"] for t in sq.transactions_for(2)] == ["t1"]
+    assert [f["id"] for f in sq.files_for(1)] == ["f1"]
+    assert [c["id"] for c in sq.load()["conversations"]] == ["c1"]
+    # 再跑一遍是幂等的（INSERT OR REPLACE）
+    m.migrate_json_to_sqlite(snap, db, log)
+    assert len(m.SqliteStore(db).load()["transactions"]) == 3
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_archive_in_chunks(fba, mode, monkeypatch):
+    m = fba(mode)
+    ts = "2025-01-01T00:00:00+00:00"
+    ops = []
+    for i in range(300):
+        day = f"2025-01-{i % 28 + 1:02d}"
+        ops.append(m.add_op("transactions", {"id": f"t{i}", "user_id": i % 3, "timestamp": ts, "source_text": f"s{i}",
+                                             "data": {"type": "expense", "amount": 1, "date": day}}))
+        ops.append(m.add_op("conversations", {"id": f"c{i}", "user_id": i % 3, "timestamp": ts, "text": "x"}))
+    m.WRITER.submit(None, ops).result()
+
+    sizes = []
+    submit = m.WRITER.submit
+    monkeypatch.setattr(m, "ARCHIVE_CHUNK", 64)
+    monkeypatch.setattr(m.WRITER, "submit", lambda user_id, ops: sizes.append(len(ops)) or submit(user_id, ops))
+    assert m.archive_old_records(days=-1) == (300, 300)
+    assert sizes == [64] * 9 + [24]
+
+    data = m.get_store().load()
+    assert data["conversations"] == []
+    assert sorted(t["id"] for t in data["transactions"]) == sorted(f"t{i}" for i in range(300))
+    assert all("source_text" not in t for t in data["transactions"])
+    assert m.archive_old_records(days=-1) == (0, 0)
@@ -0,0 +1,199 @@
+import asyncio
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from aiogram.types import Message
+
+
+def message(update_id, chat_id, text="такси 2000"):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "u"}}}
+
+
+def replay_updates():
+    """三个 chat 交错到达，每第 5 条被 Telegram 重发一次。"""
+    updates, uid = [], 0
+    for i in range(30):
+        for chat in (1, 2, 3):
+            uid += 1
+            updates.append(message(uid, chat))
+            if uid % 5 == 0:
+                updates.append(message(uid, chat))
+    return updates
+
+
+def wait_until(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def serve(m, dispatcher):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), m.make_webhook_handler(dispatcher, "/telegram", ""))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/telegram" % server.server_address[1]
+
+
+def check_replay(seen):
+    for chat in (1, 2, 3):
+        ids = [uid for c, uid in seen if c == chat]
+        assert ids == sorted(ids) and len(ids) == 30
+    assert len(seen) == len({uid for _c, uid in seen})
+
+
+# -------------------- finance_bot_ai：线程池 + http.server --------------------
+def test_threaded_webhook_order_and_dedup(fba_module):
+    m = fba_module
+    seen, lock = [], threading.Lock()
+
+    def handle(update):
+        time.sleep(random.random() / 500)
+        with lock:
+            seen.append((update["message"]["chat"]["id"], update["update_id"]))
+
+    dispatcher = m.UpdateDispatcher(handle, workers=4)
+    server, url = serve(m, dispatcher)
+    try:
+        for update in replay_updates():
+            assert requests.post(url, json=update, timeout=5).status_code == 200
+        wait_until(lambda: dispatcher.pending == 0)
+    finally:
+        server.shutdown()
+        dispatcher.shutdown()
+    check_replay(seen)
+
+
+def test_threaded_webhook_busy_then_retry(fba_module):
+    m = fba_module
+    gate, seen = threading.Event(), []
+    dispatcher = m.UpdateDispatcher(lambda u: (gate.wait(5), seen.append(u["update_id"])), max_pending=2)
+    server, url = serve(m, dispatcher)
+    try:
+        codes = [requests.post(url, json=message(uid, 1), timeout=5).status_code for uid in (1, 2, 3)]
+        assert codes == [200, 200, 503]
+        gate.set()
+        wait_until(lambda: dispatcher.pending == 0)
+        # 503 的更新没有记进去重表，Telegram 重发时照常处理
+        assert requests.post(url, json=message(3, 1), timeout=5).status_code == 200
+        wait_until(lambda: dispatcher.pending == 0)
+    finally:
+        server.shutdown()
+        dispatcher.shutdown()
+    assert seen == [1, 2, 3]
+
+
+def test_threaded_webhook_reaches_handlers(fba_module, monkeypatch):
+    m = fba_module
+    replies = []
+    monkeypatch.setattr(m.bot, "threaded", False)
+    monkeypatch.setattr(m.bot, "reply_to", lambda msg, text, **kw: replies.append((msg.chat.id, text)))
+    dispatcher = m.UpdateDispatcher(m.process_update)
+    server, url = serve(m, dispatcher)
+    try:
+        assert requests.post(url, json=message(1, 42, "/start"), timeout=5).status_code == 200
+        wait_until(lambda: dispatcher.pending == 0)
+    finally:
+        server.shutdown()
+        dispatcher.shutdown()
+    assert replies == [(42, m.KZ["greeting"])]
+
+
+# -------------------- bot.py：asyncio + aiohttp --------------------
+async def bot_webhook(b, body):
+    """起 bot.py 的 aiohttp webhook（随机端口），await body(post)，post(update) 返回 HTTP 状态码。"""
+    import aiohttp
+    runner = await b.start_webhook(port=0)
+    port = runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def post(update):
+                async with session.post("http://127.0.0.1:%d%s" % (port, b.WEBHOOK_PATH), json=update) as resp:
+                    return resp.status
+            return await body(post)
+    finally:
+        await runner.cleanup()
+
+
+def run_bot_webhook(b, monkeypatch, body, **dispatcher_kw):
+    real = b.UpdateDispatcher
+    monkeypatch.setattr(b, "UpdateDispatcher", lambda handle: real(handle, **dispatcher_kw))
+    return asyncio.run(bot_webhook(b, body))
+
+
+def test_async_webhook_order_and_dedup(bot_module, monkeypatch):
+    b = bot_module
+    seen = []
+
+    async def feed(bot, update):
+        await asyncio.sleep(random.random() / 500)
+        seen.append((update["message"]["chat"]["id"], update["update_id"]))
+
+    monkeypatch.setattr(b.dp, "feed_raw_update", feed)
+
+    async def body(post):
+        for update in replay_updates():
+            assert await post(update) == 200
+        while len(seen) < 90:
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.05)
+
+    run_bot_webhook(b, monkeypatch, body, workers=4)
+    check_replay(seen)
+
+
+def test_async_webhook_busy_then_retry(bot_module, monkeypatch):
+    b = bot_module
+    seen = []
+
+    async def body(post):
+        gate = asyncio.Event()
+
+        async def feed(bot, update):
+            await gate.wait()
+            seen.append(update["update_id"])
+
+        monkeypatch.setattr(b.dp, "feed_raw_update", feed)
+        assert [await post(message(uid, 1)) for uid in (1, 2, 3)] == [200, 200, 503]
+        gate.set()
+        while len(seen) < 2:
+            await asyncio.sleep(0.005)
+        assert await post(message(3, 1)) == 200
+        while len(seen) < 3:
+            await asyncio.sleep(0.005)
+
+    run_bot_webhook(b, monkeypatch, body, max_pending=2)
+    assert seen == [1, 2, 3]
+
+
+def test_async_webhook_reaches_handlers(botdb, monkeypatch):
+    replies = []
+
+    async def answer(self, text, **kwargs):
+        replies.append((self.chat.id, text))
+
+    monkeypatch.setattr(Message, "answer", answer)
+
+    async def send(post):
+        assert await post(message(1, 42, "/start")) == 200
+        while not replies:
+            await asyncio.sleep(0.005)
+
+    botdb(lambda b: bot_webhook(b, send))
+    assert replies and replies[0][0] == 42
+
+
+
+def test_both_bots_share_dispatch_module(fba_module, bot_module):
+    import update_dispatch
+    assert fba_module.UpdateDispatcher is update_dispatch.UpdateDispatcher
+    assert bot_module.UpdateDispatcher is update_dispatch.AsyncUpdateDispatcher
+    assert update_dispatch.update_chat_key(message(1, 7)) == 7
+    assert update_dispatch.update_chat_key({"update_id": 5, "callback_query": {"from": {"id": 9}}}) == 9
+    assert update_dispatch.update_chat_key({"update_id": 5, "poll": {}}) == ("update", 5)
@@ -0,0 +1,134 @@
+"""
+两个机器人共用的 webhook 更新分发：按 chat 串行、整体限并发、按 update_id 去重、排队过多时拒收。
+finance_bot_ai.py 用线程池版，bot.py 用 asyncio 版；去重和排队的记账逻辑只有这一份。
+"""
+import asyncio
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+WEBHOOK_WORKERS = 8
+WEBHOOK_MAX_PENDING = 1000     # 排队中的更新超过该数时返回 503，让 Telegram 稍后重发
+WEBHOOK_DEDUP_WINDOW = 10000   # 记住最近多少个 update_id 用于去重
+
+def update_chat_key(update: Dict[str, Any]) -> Any:
+    """同一 chat 的更新要串行处理；取不到 chat 的更新各自独立。"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in update:
+            return update[field].get("chat", {}).get("id")
+    if "callback_query" in update:
+        msg = update["callback_query"].get("message") or {}
+        return msg.get("chat", {}).get("id") or update["callback_query"].get("from", {}).get("id")
+    return ("update", update.get("update_id"))
+
+class UpdateQueues:
+    """
+    分发器的记账部分：最近 update_id 的去重窗口、排队总数、每个 chat 的待处理队列（队首是正在处理的那条）。
+    本身不加锁，也不负责执行；子类在自己的并发模型下调用 _enqueue / _next / _done。
+    """
+
+    def __init__(self, max_pending: int = WEBHOOK_MAX_PENDING, dedup_window: int = WEBHOOK_DEDUP_WINDOW):
+        self.max_pending = max_pending
+        self.dedup_window = dedup_window
+        self._chats: Dict[Any, deque] = {}    # 有活跃排空者的 chat -> 待处理更新
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self.pending = 0
+
+    def _enqueue(self, update: Dict[str, Any]) -> Tuple[str, Any, bool]:
+        """返回 (状态, chat 键, 是否要为该 chat 起排空者)；状态为 "ok"、"duplicate" 或 "busy"。"""
+        uid = update.get("update_id")
+        if uid is not None and uid in self._seen:
+            return "duplicate", None, False
+        if self.pending >= self.max_pending:
+            return "busy", None, False   # 不记进去重表，Telegram 重发时照常处理
+        if uid is not None:
+            self._seen[uid] = None
+            while len(self._seen) > self.dedup_window:
+                self._seen.popitem(last=False)
+        self.pending += 1
+        key = update_chat_key(update)
+        q = self._chats.get(key)
+        if q is not None:
+            q.append(update)   # 该 chat 的排空者处理完前一条后会接着取
+            return "ok", key, False
+        self._chats[key] = deque([update])
+        return "ok", key, True
+
+    def _next(self, key: Any) -> Optional[Dict[str, Any]]:
+        """该 chat 的下一条更新；队列空了就注销这个 chat，返回 None。"""
+        q = self._chats[key]
+        if not q:
+            del self._chats[key]
+            return None
+        return q[0]
+
+    def _done(self, key: Any) -> None:
+        self._chats[key].popleft()
+        self.pending -= 1
+
+class UpdateDispatcher(UpdateQueues):
+    """线程池版：handle(update) 是普通函数，不同 chat 在 workers 个线程里并行。"""
+
+    def __init__(self, handle: Callable[[Dict[str, Any]], None], workers: int = WEBHOOK_WORKERS,
+                 max_pending: int = WEBHOOK_MAX_PENDING, dedup_window: int = WEBHOOK_DEDUP_WINDOW):
+        super().__init__(max_pending, dedup_window)
+        self.handle = handle
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+        self._lock = threading.Lock()
+
+    def submit(self, update: Dict[str, Any]) -> str:
+        """返回 "ok"、"duplicate" 或 "busy"。"""
+        with self._lock:
+            status, key, first = self._enqueue(update)
+        if first:
+            self._pool.submit(self._drain, key)
+        return status
+
+    def _drain(self, key: Any) -> None:
+        while True:
+            with self._lock:
+                update = self._next(key)
+            if update is None:
+                return
+            try:
+                self.handle(update)
+            except Exception:
+                logging.exception("update handling failed")
+            with self._lock:
+                self._done(key)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
+
+class AsyncUpdateDispatcher(UpdateQueues):
+    """asyncio 版：handle(update) 是协程函数，每个 chat 一个排空任务，信号量限制同时处理的更新数。"""
+
+    def __init__(self, handle: Callable[[Dict[str, Any]], Awaitable[Any]], workers: int = WEBHOOK_WORKERS,
+                 max_pending: int = WEBHOOK_MAX_PENDING, dedup_window: int = WEBHOOK_DEDUP_WINDOW):
+        super().__init__(max_pending, dedup_window)
+        self.handle = handle
+        self._slots = asyncio.Semaphore(workers)
+        self._tasks: set = set()
+
+    def submit(self, update: Dict[str, Any]) -> str:
+        """返回 "ok"、"duplicate" 或 "busy"；必须在事件循环里调用。"""
+        status, key, first = self._enqueue(update)
+        if first:
+            task = asyncio.create_task(self._drain(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return status
+
+    async def _drain(self, key: Any) -> None:
+        while True:
+            update = self._next(key)
+            if update is None:
+                return
+            async with self._slots:
+                try:
+                    await self.handle(update)
+                except Exception:
+                    logging.exception("update handling failed")
+            self._done(key)